@@ -0,0 +1,392 @@
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import argparse
+import functools
+import resource
+import subprocess
+import tempfile
+
+import issues_8_cmd
+
+# Benchmarks for issues_8_cmd.py on synthetic qradar.error logs.
+#
+#   python bench_issues_8.py generate DIR [--files 26 --lines 20000 --mix oom=1,noise=500 --compression gz]
+#   python bench_issues_8.py run [--dir DIR] [--jobs 1,4] [--threads 0,1] [--json]
+#   python bench_issues_8.py check [--length 100000 --budget-ms 50]
+#
+# "run" generates a log tree first unless --dir points at one, then measures the whole
+# process_logs scan (lines/sec, peak RSS of the scanning process and of the largest --jobs
+# worker, each in a fresh interpreter), the same scan looking for one detector at a time,
+# every decompression backend available for the archives (MB/s of decompressed output, the
+# one the scan uses marked) and every detector pattern on its own (lines/sec over the lines
+# its literals let through, and over all lines).
+# "check" exits non-zero when any pattern takes longer than the budget on one of the
+# adversarial long lines below, which is what a backtracking regression looks like.
+
+hosts = ['qradar-console', 'qradar-ep01', 'qradar-fc02']
+services = ['ecs-ec', 'ecs-ep', 'ecs-ec-ingress', 'tomcat', 'hostcontext', 'ariel_proxy_server', 'accumulator']
+caches = ['FlowSourceCache', 'AssetProfileCache', 'ReferenceSetCache', 'DomainCache', 'OffenseCache']
+interfaces = ['eth0', 'eth1', 'ens192', 'bond0']
+ports = ['7777', '7778', '7779', '32006', '32010']
+queries = [
+    "select * from reference_data_element where rdk_id = 1052",
+    "update offense set last_event = now() where id = 48113",
+    "select count(*) from qidmap q join sensordevice s on s.id = q.id where q.qid between 1000 and 200000",
+]
+
+# Relative weight of each kind of line; noise dominates as it does on a real console
+default_mix = {
+    'oom': 1,
+    'txsentry': 4,
+    'reference_data': 1,
+    'expensive_rules': 1,
+    'too_many_open': 1,
+    'cache_overflow': 6,
+    'dropped_receive': 2,
+    'connect_localhost': 2,
+    'noise': 500,
+}
+
+def syslog_date(ts):
+    t = time.gmtime(ts)
+    return f"{time.strftime('%b', t)} {t.tm_mday:2d} {time.strftime('%H:%M:%S', t)}"
+
+def noise_line(rng, date, host):
+    service = rng.choice(services)
+    pid = rng.randint(1000, 60000)
+    return rng.choice([
+        f"{date} {host} {service}[{pid}]: [INFO] [NOT:0000006000][10.1.2.{rng.randint(1, 254)}/- -] [-/- -]com.q1labs.semsources.sources.base.SourceMonitor: Events per second {rng.randint(0, 50000)}",
+        f"{date} {host} {service}[{pid}]: [{service}.{service}] [Timer-{rng.randint(1, 40)}] com.q1labs.core.shared.ariel.CommandStatistics: [INFO] [NOT:0000006000][10.1.2.3/- -] [-/- -]Query {rng.getrandbits(64):x} finished in {rng.randint(1, 900)} ms",
+        f"{date} {host} {service}[{pid}]: [WARN] [NOT:0000004000][10.1.2.3/- -] [-/- -]com.q1labs.sem.monitors.StatisticsMonitor: Throughput {rng.random():.4f} of license, buffer {rng.randint(0, 100)}% full",
+        f"{date} {host} systemd[1]: Started Session {rng.randint(1, 99999)} of user root.",
+        f"{date} {host} {service}[{pid}]:     at com.q1labs.frameworks.core.ThreadPool$Worker.run(ThreadPool.java:{rng.randint(100, 900)})",
+    ])
+
+# Writes the lines of one kind for one timestamp. TxSentry mostly writes an unmanaged-process
+# line and its query line on the same thread_key, with another thread's pair interleaved half
+# the time.
+def event_lines(rng, kind, date, host):
+    pid = rng.randint(1000, 60000)
+    service = rng.choice(services)
+    if kind == 'oom':
+        return [rng.choice([
+            f"{date} {host} OutOfMemoryMonitor[{pid}]: Discovered out-of-memory error for {service} (type java)",
+            f"{date} {host} OutOfMemoryMonitor[{pid}]: Discovered out-of-memory error for {service} process.",
+            f"{date} {host} {service}[{pid}]: [Thread-{rng.randint(1, 300)}] java.lang.OutOfMemoryError: Java heap space",
+        ])]
+    if kind == 'txsentry':
+        ip = f"10.1.2.{rng.randint(1, 254)}"
+        prefix = f"{date} {host} hostcontext[{pid}]: [INFO] [hostcontext.hostcontext]"
+        def thread_lines(thread_key, tx_pid):
+            return [
+                f"{prefix} [{thread_key}/Sequential-1] com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][{ip}/- -] [-/- -]Found unmanaged process on host {ip}: /usr/bin/httpd, pid={tx_pid}, started 3600s ago",
+                f"{prefix} [{thread_key}/Sequential-1] com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][{ip}/- -] [-/- -]TX on host {ip}: pid={tx_pid} age={rng.randint(60, 7200)} query='{rng.choice(queries)}'",
+            ]
+        if rng.random() < 0.2:
+            return [f"{prefix} [tx-{rng.randint(1, 8)}/Sequential-1] com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][{ip}/- -] [-/- -]Found a process on host {ip}: {service}, pid={pid}, managed"]
+        first = thread_lines(f"tx-{rng.randint(1, 8)}", pid)
+        if rng.random() < 0.5:
+            return first
+        second = thread_lines(f"tx-{rng.randint(9, 16)}", pid + 1)
+        return [first[0], second[0], first[1], second[1]]
+    if kind == 'reference_data':
+        return [f"{date} {host} tomcat[{pid}]: [INFO] [ReferenceDataProcessorThread] ReferenceDataProcessorThread - We have crossed the update threshold of {rng.randint(1000, 90000)} elements"]
+    if kind == 'expensive_rules':
+        rules = ', '.join(f"Rule {rng.randint(100, 999)} ({rng.random():.3f} ms)" for _ in range(rng.randint(1, 6)))
+        return [f"{date} {host} ecs-ep[{pid}]: [INFO] [ecs-ep.ecs-ep] Expensive Custom Rules Based On Average Throughput: {rules}"]
+    if kind == 'too_many_open':
+        return [f"{date} {host} {service}[{pid}]: [{service}.{service}] [pool-{rng.randint(1, 9)}] java.io.IOException: Too many open files"]
+    if kind == 'cache_overflow':
+        return [f"{date} {host} ecs-ec[{pid}]: [ecs-ec.ecs-ec] [pool-1] com.q1labs.frameworks.cache.ChainAppendCache: [WARN] [NOT:0000004000][10.1.2.3/- -] [-/- -]{rng.choice(caches)} is experiencing heavy COLLISIONS exceeding configured threshold {rng.randint(10, 99)}"]
+    if kind == 'dropped_receive':
+        return [f"{date} {host} hostcontext[{pid}]: Dropped receive packets on interface {rng.choice(interfaces)} has an average of {rng.uniform(1, 500):.2f} over the past 5 intervals, and has exceeded the configured threshold of 1.00"]
+    if kind == 'connect_localhost':
+        return [f"{date} {host} {service}[{pid}]: [{service}.{service}] [main]Unable to connect to server localhost:{rng.choice(ports)}"]
+    return [noise_line(rng, date, host)]
+
+# Lines of one file covering one day from start_ts, at least line_count of them
+def file_lines(rng, start_ts, line_count, mix):
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    host = rng.choice(hosts)
+    written = 0
+    while written < line_count:
+        date = syslog_date(start_ts + written * 86400 // line_count)
+        for line in event_lines(rng, rng.choices(kinds, weights)[0], date, host):
+            yield line
+            written += 1
+
+# Writes var/log/qradar.error and var/log/qradar.old/qradar.error.N.gz (or .bz2, .xz) under
+# root, one day per file, oldest in the highest-numbered archive. The same seed gives the
+# same files.
+def generate_logs(root, files=26, lines=20000, mix=None, seed=1, compression='gz'):
+    rng = random.Random(seed)
+    mix = mix or default_mix
+    os.makedirs(os.path.join(root, 'var/log/qradar.old'), exist_ok=True)
+    start_ts = 1709251200  # Mar  1 00:00:00
+    total = 0
+    for number in range(files - 1, -1, -1):
+        if number:
+            path = os.path.join(root, f'var/log/qradar.old/qradar.error.{number}.{compression}')
+            if compression == 'gz':
+                file = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+            else:
+                file = issues_8_cmd.archive_openers['.' + compression](path, 'wt', encoding='utf-8')
+        else:
+            file = open(os.path.join(root, 'var/log/qradar.error'), 'w', encoding='utf-8')
+        with file:
+            for line in file_lines(rng, start_ts + (files - 1 - number) * 86400, lines, mix):
+                file.write(line + '\n')
+                total += 1
+    return total
+
+# Long lines that carry a detector's literals, repeated, without matching it: query dumps,
+# runs of brackets, colons and whitespace, and dates repeated inside the message
+def adversarial_lines(length):
+    date = "Mar  3 10:00:04 qradar-console "
+    def repeat(text):
+        return text * max(1, length // len(text))
+    return {
+        'txsentry_query': date + "hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-1/Sequential-1] com.q1labs.hostcontext.tx.TxSentry: [INFO] TX on host 10.1.2.3: pid=4 query='" + repeat("select a: b, c from t where x = 'TxSentry' and host : y ") + "'",
+        'txsentry_repeated': date + "hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-1/Sequential-1] " + repeat("TxSentry: host : Found unmanaged process on host x: "),
+        'txsentry_tags': date + repeat("x [hostcontext.hostcontext] [a/Sequential ") + "TxSentry",
+        'too_many_open': date + "ecs-ec[1]: " + repeat("foo(bar) baz[1] [a.b] ") + "Too many open connections",
+        'too_many_open_tail': date + "ecs-ec[1]: Too many open " + repeat("a[b] x(y) "),
+        'cache_overflow': date + "ecs-ec[1]: [ecs-ec.ecs-ec] [pool-1] " + repeat("[a.b] [c com.q1labs.frameworks.cache.ChainAppendCache: [WARN] [NOT ") + " is experiencing heavy",
+        'oom': date + "ecs-ec[1]: " + repeat("[Thread-1] OutOfMemoryMonitor[1]: Discovered out-of-memory error for ") + " OutOfMemoryError",
+        'dropped_receive': date + "hostcontext[1]: Dropped receive packets on interface eth0 has an average of 1.0 over the past " + repeat("intervals, and has exceeded "),
+        'connect_localhost': date + "tomcat[1]: " + repeat("]Unable to connect to server localhost:") + "x",
+        'reference_data': date + "tomcat[1]: " + repeat("ReferenceDataProcessorThread - "),
+        'expensive_rules': date + "ecs-ep[1]: " + repeat("Expensive Custom Rules Based On Average Throughput"),
+        'whitespace': date + "x " + repeat(" \t") + "TxSentry Too many open OutOfMemoryError",
+        'dates': repeat("Mar  3 10:00:04 ") + "TxSentry Too many open  is experiencing heavy ",
+    }
+
+# Slowest search of every pattern over the adversarial lines, best of a few runs. The scan
+# matches raw lines, so the bytes patterns are the ones timed.
+def check_patterns(length=100000, repeat=3):
+    lines = {name: line.encode() for name, line in adversarial_lines(length).items()}
+    results = []
+    for detector in issues_8_cmd.detectors:
+        for index, pattern in enumerate(detector['byte_patterns']):
+            worst, worst_line = 0.0, None
+            for name, line in lines.items():
+                elapsed = float('inf')
+                for _ in range(repeat):
+                    started = time.perf_counter()
+                    pattern.search(line)
+                    elapsed = min(elapsed, time.perf_counter() - started)
+                if elapsed > worst:
+                    worst, worst_line = elapsed, name
+            results.append({'category': detector['category'], 'pattern': index, 'seconds': worst, 'line': worst_line})
+    return results
+
+def parse_mix(value):
+    mix = dict(default_mix)
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        if kind not in mix:
+            raise argparse.ArgumentTypeError(f"unknown line kind {kind}, expected one of {', '.join(mix)}")
+        mix[kind] = float(weight)
+    return mix
+
+def count_lines(root):
+    return sum(block.count(b'\n') for path in issues_8_cmd.log_files(root) for block in issues_8_cmd.read_blocks(path))
+
+# Decompression speed of every backend that can read the archives, gzip.open included as the
+# baseline for .gz, in MB/s of decompressed output
+def bench_decompression(root):
+    archives = [path for path in issues_8_cmd.log_files(root) if issues_8_cmd.is_archive(path)]
+    results = []
+    for suffix, open_func in issues_8_cmd.archive_openers.items():
+        paths = [path for path in archives if path.endswith(suffix)]
+        if not paths:
+            continue
+        if suffix == '.gz':
+            backends = ['zlib'] + [name for name, command in issues_8_cmd.gzip_commands.items() if shutil.which(command[0])]
+        else:
+            backends = [suffix[1:]]
+        decompressors = {name: issues_8_cmd.decompressors[name] for name in backends}
+        if suffix == '.gz':
+            decompressors['gzip.open'] = functools.partial(issues_8_cmd.stream_blocks, gzip.open)
+        for name, decompressor in decompressors.items():
+            started = time.perf_counter()
+            size = sum(len(block) for path in paths for block in decompressor(path))
+            elapsed = time.perf_counter() - started
+            results.append({
+                'format': suffix[1:],
+                'backend': name,
+                'used': name == issues_8_cmd.file_backend(paths[0]),
+                'compressed_mb': sum(os.path.getsize(path) for path in paths) / 1e6,
+                'mb': size / 1e6,
+                'seconds': elapsed,
+                'mb_per_sec': size / 1e6 / elapsed if elapsed else None,
+            })
+    return results
+
+# Leaves only one detector in the dispatch tables, so a scan reads everything but only looks
+# for that detector's literals and runs its patterns
+def only_detector(category):
+    index = [detector['category'] for detector in issues_8_cmd.detectors].index(category)
+    issues_8_cmd.dispatch = [(literal, (index,)) for literal in issues_8_cmd.detectors[index]['literals']]
+    issues_8_cmd.byte_dispatch = [(literal.encode(), indexes) for literal, indexes in issues_8_cmd.dispatch]
+    issues_8_cmd.keywords = [literal for literal, indexes in issues_8_cmd.byte_dispatch]
+
+# Runs in a fresh interpreter (the "scan" subcommand) so peak RSS belongs to this scan only
+def scan_once(root, jobs, threads, detector=None):
+    if detector is not None:
+        only_detector(detector)
+    os.chdir(root)
+    events = {detector['category']: [] for detector in issues_8_cmd.detectors}
+    started = time.perf_counter()
+    issues_8_cmd.process_logs(events, issues_8_cmd.RecentKeys(3600), jobs, threads=threads)
+    elapsed = time.perf_counter() - started
+    return {
+        'detector': detector,
+        'jobs': jobs,
+        'threads': threads,
+        'seconds': elapsed,
+        'events': {category: len(event_list) for category, event_list in events.items()},
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # Largest of the --jobs worker processes, which RUSAGE_SELF leaves out
+        'worker_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+def bench_scan(root, jobs, threads, total_lines, detector=None):
+    command = [sys.executable, os.path.abspath(__file__), 'scan', root, '--jobs', str(jobs), '--threads', str(threads)]
+    if detector is not None:
+        command += ['--detector', detector]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output)
+    result['lines_per_sec'] = total_lines / result['seconds']
+    return result
+
+# Times every pattern of every detector on a sample of the generated lines: over the lines that
+# pass the detector's literals (what the scan pays) and over all lines (the raw regex cost)
+def bench_patterns(root, sample_lines=50000):
+    lines = []
+    for path in reversed(issues_8_cmd.log_files(root)):
+        open_func = issues_8_cmd.archive_openers.get(os.path.splitext(path)[1], open)
+        with open_func(path, 'rb') as file:
+            for line in file:
+                lines.append(line.rstrip(b'\n'))
+                if len(lines) >= sample_lines:
+                    break
+        if len(lines) >= sample_lines:
+            break
+
+    results = []
+    for detector in issues_8_cmd.detectors:
+        literals = [literal.encode() for literal in detector['literals']]
+        candidates = [line for line in lines if any(literal in line for literal in literals)]
+        for index, pattern in enumerate(detector['byte_patterns']):
+            row = {'category': detector['category'], 'pattern': index, 'candidates': len(candidates)}
+            for name, subset in (('candidates', candidates), ('all', lines)):
+                search = pattern.search
+                started = time.perf_counter()
+                matched = sum(1 for line in subset if search(line))
+                elapsed = time.perf_counter() - started
+                row[f'{name}_matched'] = matched
+                row[f'{name}_lines_per_sec'] = len(subset) / elapsed if elapsed else None
+            results.append(row)
+
+    started = time.perf_counter()
+    for line in lines:
+        issues_8_cmd.match_line(line)
+    elapsed = time.perf_counter() - started
+    results.append({'category': 'match_line', 'pattern': None, 'candidates': len(lines), 'all_lines_per_sec': len(lines) / elapsed})
+    return results
+
+def print_report(report):
+    print(f"{report['total_lines']} lines in {report['files']} files under {report['root']}")
+    print()
+    print(f"{'jobs':>4} {'threads':>7} {'seconds':>9} {'lines/s':>12} {'peak MB':>9} {'worker MB':>9} {'events':>9}")
+    for scan in report['scans']:
+        print(f"{scan['jobs']:>4} {scan['threads']:>7} {scan['seconds']:>9.2f} {scan['lines_per_sec']:>12,.0f} {scan['peak_rss_mb']:>9.1f} "
+              f"{scan['worker_peak_rss_mb']:>9.1f} {sum(scan['events'].values()):>9}")
+    print()
+    print(f"{'detector alone':<30} {'seconds':>9} {'lines/s':>12} {'peak MB':>9} {'events':>9}")
+    for scan in report['detector_scans']:
+        print(f"{scan['detector']:<30} {scan['seconds']:>9.2f} {scan['lines_per_sec']:>12,.0f} {scan['peak_rss_mb']:>9.1f} {scan['events'][scan['detector']]:>9}")
+    print()
+    print(f"{'format':<6} {'backend':<10} {'in MB':>9} {'out MB':>9} {'seconds':>9} {'MB/s':>9}")
+    for row in report['decompression']:
+        print(f"{row['format']:<6} {row['backend']:<10} {row['compressed_mb']:>9.1f} {row['mb']:>9.1f} {row['seconds']:>9.2f} "
+              f"{row['mb_per_sec']:>9.1f}{'  (used)' if row['used'] else ''}")
+    print()
+    print(f"{'detector':<30} {'pat':>3} {'cand':>7} {'matched':>8} {'cand lines/s':>14} {'all lines/s':>14}")
+    for row in report['patterns']:
+        cand_rate = row.get('candidates_lines_per_sec')
+        print(f"{row['category']:<30} {'' if row['pattern'] is None else row['pattern']:>3} {row['candidates']:>7} "
+              f"{row.get('candidates_matched', ''):>8} {'' if cand_rate is None else f'{cand_rate:,.0f}':>14} {row['all_lines_per_sec']:>14,.0f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='write a synthetic log tree')
+    generate.add_argument('dir')
+    run = subparsers.add_parser('run', help='generate (unless --dir) and benchmark')
+    run.add_argument('--dir', help='existing log tree to benchmark')
+    run.add_argument('--jobs', default='1', help='comma-separated --jobs values to time, e.g. 1,4')
+    run.add_argument('--threads', default='1', help='comma-separated --threads values to time with each --jobs value, e.g. 0,1')
+    run.add_argument('--sample', type=int, default=50000, help='lines used for the per-pattern timings')
+    run.add_argument('--json', action='store_true', help='print the results as JSON')
+    for subparser in (generate, run):
+        subparser.add_argument('--files', type=int, default=26, help='number of log files, the live one included')
+        subparser.add_argument('--lines', type=int, default=20000, help='lines per file')
+        subparser.add_argument('--mix', type=parse_mix, help='line kind weights, e.g. oom=5,cache_overflow=50,noise=100')
+        subparser.add_argument('--seed', type=int, default=1)
+        subparser.add_argument('--compression', choices=['gz', 'bz2', 'xz'], default='gz', help='format of the rotated archives')
+    check = subparsers.add_parser('check', help='fail if a pattern is too slow on adversarial long lines')
+    check.add_argument('--length', type=int, default=100000, help='approximate length of each adversarial line')
+    check.add_argument('--budget-ms', type=float, default=50.0, help='longest a pattern may take on one line')
+    scan = subparsers.add_parser('scan')
+    scan.add_argument('dir')
+    scan.add_argument('--jobs', type=int, default=1)
+    scan.add_argument('--threads', type=int, default=1)
+    scan.add_argument('--detector', help='category of the only detector to look for')
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        print(generate_logs(args.dir, args.files, args.lines, args.mix, args.seed, args.compression), 'lines written')
+        return
+    if args.command == 'scan':
+        print(json.dumps(scan_once(args.dir, args.jobs, args.threads, args.detector)))
+        return
+    if args.command == 'check':
+        failed = False
+        for row in check_patterns(args.length):
+            over = row['seconds'] * 1000 > args.budget_ms
+            failed = failed or over
+            print(f"{row['category']:<30} {row['pattern']:>3} {row['seconds'] * 1000:>9.2f} ms  {row['line']}{'  OVER BUDGET' if over else ''}")
+        sys.exit(1 if failed else 0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root = os.path.abspath(args.dir or tmp_dir)
+        if not args.dir:
+            generate_logs(root, args.files, args.lines, args.mix, args.seed, args.compression)
+        os.chdir(root)
+        report = {
+            'root': root,
+            'files': len(issues_8_cmd.log_files()),
+            'total_lines': count_lines(root),
+        }
+        report['scans'] = [bench_scan(root, int(jobs), int(threads), report['total_lines'])
+                           for jobs in args.jobs.split(',') for threads in args.threads.split(',')]
+        report['detector_scans'] = [bench_scan(root, 1, 1, report['total_lines'], detector['category']) for detector in issues_8_cmd.detectors]
+        report['decompression'] = bench_decompression(root)
+        report['patterns'] = bench_patterns(root, args.sample)
+        os.chdir('/')
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
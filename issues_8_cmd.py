@@ -1,63 +1,96 @@
 import re
 import json
 import os
+import sys
+import gzip
+import bz2
+import lzma
+import zlib
+import shutil
+import signal
+import subprocess
+import argparse
+import calendar
+import collections
 import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+import mmap
+import operator
+import queue
+import sqlite3
+import threading
+import time
+import urllib.parse
 from glob import glob
+from concurrent.futures import ProcessPoolExecutor
+
+# Every pattern is anchored at the syslog date that starts the line, and the gaps between the
+# fixed parts are bounded ({0,256} rather than .*), so a long line that contains the literals
+# but does not match (a TxSentry query dump, a stack trace) is rejected in time linear in its
+# length instead of backtracking through every combination of positions. Only the captures
+# that run to the end of the line (query, rules, message) are unbounded.
+# bench_issues_8.py check times every pattern on adversarial long lines.
 
 # OOM Regular expression patterns
 oom_patterns = [
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+\S+\s+OutOfMemoryMonitor\[\d+\]: '
-        r'Discovered out-of-memory error for (?P<service>[^(]+)\(type.*'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+\S+\s+OutOfMemoryMonitor\[\d+\]: '
+        r'Discovered out-of-memory error for (?P<service>[^(]+)\(type'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+\S+\s+OutOfMemoryMonitor\[\d+\]: '
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+\S+\s+OutOfMemoryMonitor\[\d+\]: '
         r'Discovered out-of-memory error for (?P<service>\S+)\s+process\.'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[(?P<service>Thread-\d+)\]\s+java.lang.OutOfMemoryError'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[(?P<service>Thread-\d+)\]\s+java\.lang\.OutOfMemoryError'
     )
 ]
 
 # TxSentry Regular expression patterns
 txsentry_patterns = [
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[hostcontext.hostcontext\] \[(?P<thread_key>[^/]+)\/Sequential.*TxSentry.*Found unmanaged process on host .*: (?P<service>\S+), pid=(?P<pid>\d+).*'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[hostcontext\.hostcontext\] \[(?P<thread_key>[^/]{1,256})/Sequential'
+        r'.{0,256}TxSentry.{0,256}Found unmanaged process on host .{0,256}: (?P<service>\S+), pid=(?P<pid>\d+)'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[hostcontext.hostcontext\] \[(?P<thread_key>[^/]+)\/Sequential.*TxSentry:.*TX on host .*: pid=(?P<pid>\d+).* query=\'(?P<query>.+)\''
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[hostcontext\.hostcontext\] \[(?P<thread_key>[^/]{1,256})/Sequential'
+        r'.{0,256}TxSentry:.{0,256}TX on host .{0,256}: pid=(?P<pid>\d+).* query=\'(?P<query>.+)\''
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[hostcontext.hostcontext\] \[(?P<thread_key>[^/]+)\/Sequential.*TxSentry:.*Found a process on host .*: (?P<service>\S+), pid=(?P<pid>\d+).*'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[hostcontext\.hostcontext\] \[(?P<thread_key>[^/]{1,256})/Sequential'
+        r'.{0,256}TxSentry:.{0,256}Found a process on host .{0,256}: (?P<service>\S+), pid=(?P<pid>\d+)'
     )
 ]
 
 # ReferenceDataProcessorThread pattern
 reference_data_processor_thread_pattern = re.compile(
-    r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*ReferenceDataProcessorThread - We have crossed the update threshold.*'
+    r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}ReferenceDataProcessorThread - We have crossed the update threshold'
 )
 
 # Expensive Custom Rules pattern
 expensive_rules_pattern = re.compile(
-    r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*Expensive Custom Rules Based On Average Throughput: (?P<rules>.*)'
+    r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}Expensive Custom Rules Based On Average Throughput: (?P<rules>.*)'
 )
 
 # Too Many Open Files pattern
 too_many_open_patterns = [
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[S+\.(?P<service>\S+)\]...Too many open ...'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[S+\.(?P<service>\S{1,256})\]...Too many open ...'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\s(?P<service>\S+)\[\d+\]: ...Too many open...'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\s(?P<service>\S{1,256})\[\d+\]: ...Too many open...'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+.*?\s+(?P<service>\w+)[\[\(].*Too many open files'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s.{0,256}?\s(?P<service>\w{1,256})[\[\(].*Too many open files'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+.*?\[(?P<service>[^\]]+)\].*Too many open files'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s.{0,256}?\[(?P<service>[^\]]{1,256})\].*Too many open files'
     ),
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+.*?\[(?P<service>\w+)\.\w+\].*Too many open files'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s.{0,256}?\[(?P<service>\w{1,256})\.\w{1,256}\].*Too many open files'
     )
 ]
 
@@ -65,310 +98,1731 @@ too_many_open_patterns = [
 
 cache_overflow_patterns = [
     re.compile(
-        r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).*\[(?P<service>[^\.\]]+)[^\] \[.*com.q1labs.frameworks.cache.ChainAppendCache: \[WARN\] \[NOT.*- -\] \[-/- -\](?P<cache>\S+) (?P<message>.*)'
+        r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+).{0,256}\[(?P<service>[^\.\]]{1,256})[^\]]{0,256}\] \[.{0,256}com\.q1labs\.frameworks\.cache\.ChainAppendCache: '
+        r'\[WARN\] \[NOT.{0,256}- -\] \[-/- -\](?P<cache>\S+) (?P<message>.*)'
     )
 ]
 
 # Dropped Receive Packets pattern
 dropped_receive_pattern = re.compile(
-    r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+.*Dropped receive packets on interface (?P<interface>\S+) has an average of (?P<over_5_intervals>\d+(\.\d+)?) over the past.*intervals, and has exceeded the configured threshold of (?P<threshold>\d+(\.\d+)?).*'
+    r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s.{0,256}Dropped receive packets on interface (?P<interface>\S+) has an average of (?P<over_5_intervals>\d+(\.\d+)?) over the past.{0,256}intervals, and has exceeded the configured threshold of (?P<threshold>\d+(\.\d+)?)'
 )
 
 # Connect Localhost pattern
 connect_localhost_pattern = re.compile(
-    r'(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s+.*\]Unable to connect to server localhost:(?P<port>\d+)'
+    r'^(?P<date>\w{3}\s+\d+\s+\d+:\d+:\d+)\s.{0,256}\]Unable to connect to server localhost:(?P<port>\d+)'
 )
 
-#HERE
+# Syslog timestamps ("Mar  3 10:00:01") carry no year. The year is taken from the time of the
+# run, once, and a date more than a day ahead of it is from the previous year (December lines
+# read from older archives in January), so events keep sorting in the right order.
+# Timestamps are kept as integer seconds of the log's wall-clock time, counted as if it were UTC.
+run_now = datetime.datetime.now()
+epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+run_now_ts = calendar.timegm(run_now.timetuple())
+month_numbers = {name: number for number, name in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1)}
 
-def process_oom_event(match, events_oom, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    service_name = match.group('service')
-    event_key = (datetime_obj, service_name, 'OOM')
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_oom.append({
-            'DateTime': datetime_obj,
-            'service': service_name,
-        })
-
-def process_txsentry_event(match, events_txsentry, seen_events, last_event):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    service_name = match.group('service') if 'service' in match.groupdict() else ""
-    query = match.group('query') if 'query' in match.groupdict() else ""
-    thread_key = match.group('thread_key') if 'thread_key' in match.groupdict() else ""
-    event_key = (datetime_obj, service_name, query, thread_key, 'TxSentry')
-
-    # Check if this event should be merged with the previous one
-    if last_event and last_event['thread_key'] == thread_key and not service_name:
-        # Merge this event's query with the last event's service
-        last_event['query'] = query
-        return None  # No new event to return since it was merged
-
-    new_event = {
-        'DateTime': datetime_obj,
-        'service': service_name,
-        'query': query,
-        'thread_key': thread_key,
-    }
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_txsentry.append(new_event)
-    
-    return new_event if service_name else None  # Return the new event only if it has a service
-
-def process_reference_data_processor_event(match, events_reference_data_processor, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    event_key = (datetime_obj, 'ReferenceDataProcessorThread')
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_reference_data_processor.append({
-            'DateTime': datetime_obj
-            'message': 'We have crossed...'
-        })
-
-def process_expensive_rules_event(match, events_expensive_rules, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    rules_details = match.group('rules')
-    event_key = (datetime_obj, 'ExpensiveRules', rules_details)
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_expensive_rules.append({
-            'DateTime': datetime_obj,
-            'rules': rules_details,
-        })
-
-def process_too_many_open_event(match, events_too_many_open, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    service_name = match.group('service')
-    event_key = (datetime_obj, service_name, 'TooManyOpenFiles')
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_too_many_open.append({
-            'DateTime': datetime_obj,
-            'service': service_name,
-        })
-
-def process_cache_overflow_event(match, events_cache_overflow, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    service_name = match.group('service')
-    cache_name = match.group('cache')
-    additional_message = match.group('message').strip()  # Capture the additional message part
-    message = cache_name + ' ' + additional_message
-    event_key = (datetime_obj, service_name, cache_name, message, 'CacheOverflow')
-    if event_key not in seen_events:
-        seen_events.add(event_key)
-        events_cache_overflow.append({
-            'DateTime': datetime_obj,
-            'service': service_name,
-            'cache': cache_name, 
-            'message': message 
-        })
-
-def process_dropped_receive_event(match, events_dropped_receive, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    interface = match.group('interface')
-    over_5_intervals = match.group('over_5_intervals')
-    threshold = match.group('threshold')
-    event_key = (datetime_obj, interface, 'DroppedReceive')
+# Fixed-format replacement for strptime('%b %d %H:%M:%S %Y'), returning epoch seconds.
+# A flood repeats the same second thousands of times, so recent values are cached.
+# None for a date that cannot be one (Foo 12, Feb 30, Mar 32, 99:99:99); callers skip the line.
+@functools.lru_cache(maxsize=4096)
+def parse_syslog_date(date_str):
+    month_name, day, clock = date_str.split()
+    hour, minute, second = clock.split(':')
+    month = month_numbers.get(month_name.title())
+    if month is None:
+        return None
+    hour, minute, second = int(hour), int(minute), int(second)
+    # 60 is a leap second
+    if hour > 23 or minute > 59 or second > 60:
+        return None
+    seconds = hour * 3600 + minute * 60 + second
+    try:
+        ts = (datetime.date(run_now.year, month, int(day)).toordinal() - epoch_ordinal) * 86400 + seconds
+    except ValueError:
+        # Feb 29 outside a leap year can only be from an earlier year
+        ts = None
+    if ts is None or ts - run_now_ts > 86400:
+        try:
+            ts = (datetime.date(run_now.year - 1, month, int(day)).toordinal() - epoch_ordinal) * 86400 + seconds
+        except ValueError:
+            return None
+    return ts
+
+# A long-running --follow crosses midnight and New Year, so the reference time is moved on
+def set_run_now(now):
+    global run_now, run_now_ts
+    run_now = now
+    run_now_ts = calendar.timegm(now.timetuple())
+    parse_syslog_date.cache_clear()
+
+def epoch_to_datetime(ts):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=ts)
+
+# One matched event: its epoch seconds and the values of the detector's fields, in order.
+# Millions of these are held during a flood, so no per-instance dict.
+class Event:
+    __slots__ = ('ts', 'values')
+
+    def __init__(self, ts, values):
+        self.ts = ts
+        self.values = values
+
+# An event of one host in a multi-host report
+class HostEvent(Event):
+    __slots__ = ('host',)
+
+    def __init__(self, ts, values, host):
+        super().__init__(ts, values)
+        self.host = host
+
+# Default handler: builds the event from the detector's fields and drops duplicates of the same
+# timestamp and key fields. seen_events holds hashes of the keys rather than the keys themselves.
+def process_event(detector, groups, events, seen_events):
+    ts = parse_syslog_date(groups['date'])
+    values = tuple([getter(groups) for getter in detector['getters']])
+    event_key = hash((detector['category'], ts) + tuple([values[position] for position in detector['key_positions']]))
     if event_key not in seen_events:
         seen_events.add(event_key)
-        events_dropped_receive.append({
-            'DateTime': datetime_obj,
-            'interface': interface,
-            'over_5_intervals': over_5_intervals,
-            'threshold': threshold,
-        })
-
-
-def process_connect_localhost_event(match, events_connect_localhost, seen_events):
-    date_str = match.group('date')
-    current_year = datetime.datetime.now().year
-    date_str_with_year = f"{date_str} {current_year}"
-    datetime_obj = datetime.datetime.strptime(date_str_with_year, '%b %d %H:%M:%S %Y')
-    port = match.group('port')
-    message_1 = "Unable to connect to server localhost:"
-    event_key = (datetime_obj, port, 'ConnectLocalhost')
-    if event_key not in seen_events:
+        events.append(Event(ts, values))
+
+# TxSentry logs a "Found unmanaged process" (or "Found a process") line with the service, then
+# a "TX on host ... query=" line with its query on the same thread_key, and other threads and
+# other components log in between. Records with a service are kept open per thread_key for
+# expiry seconds of log time, and a query line is attached to the open record of its thread_key
+# (values are service, query, thread_key). A query seen before any record of its thread_key,
+# logged out of order, waits for one. A record is only passed on to the events once it is
+# closed (paired, or expiry past it), so every sink sees its final values; queries whose
+# record never came are passed on as events of their own, as unpaired queries always were.
+# Nothing is held longer than expiry seconds past the newest line, which is why the Reorder
+# window is at least default_expiry (correlator_hold).
+class TxSentryCorrelator:
+    default_expiry = 60
+
+    def __init__(self, expiry=default_expiry):
+        self.expiry = expiry
+        self.open = {}
+        self.waiting = {}
+        self.newest = None
+        # No record or waiting query is older than this
+        self.oldest = None
+
+    # Called with the time of every line scanned, TxSentry or not, so that what is closed is
+    # passed on as soon as it is expiry seconds behind the newest line
+    def advance(self, events, ts):
+        if self.newest is None or ts > self.newest:
+            self.newest = ts
+            if self.oldest is not None and self.oldest < ts - self.expiry:
+                self.release(events, ts - self.expiry)
+
+    def add(self, detector, groups, events, seen_events):
+        ts = parse_syslog_date(groups['date'])
+        service_name = sys.intern(groups.get('service', ""))
+        query = groups.get('query', "")
+        thread_key = sys.intern(groups.get('thread_key', ""))
+        event_key = hash((ts, service_name, query, thread_key, 'TxSentry'))
+        if event_key in seen_events:
+            return
         seen_events.add(event_key)
-        events_connect_localhost.append({
-            'DateTime': datetime_obj,
-            'message': message_1,
-            'port': port
-        })
-        
-#HERE
-
-#
-end_date_cmd = "tail -200 /var/log/qradar.error | grep -oP '^\w{3}\s+\d+\s+(\d+:){2}\d+' | tail -1"
-start_date_cmd = "zcat /var/log/qradar.old/$(ls -tr1 /var/log/qradar.old | grep -P 'qradar.error.\d+.gz$' | head -1) | head -200 | grep -oP '^\w{3}\s+\d+\s+(\d+:){2}\d+' | head -1"
-#
-def fetch_date(cmd):
-    try:
-        output = os.popen(cmd).read().strip()
-        # If no output is found from zcat, use tail from qradar.error
-        if not output:
-            cmd = "head -200 /var/log/qradar.error | grep -oP '^\w{3}\s+\d+\s+(\d+:){2}\d+' | head -1"
-            output = os.popen(cmd).read().strip()
-        return datetime.datetime.strptime(output, '%b %d %H:%M:%S').replace(year=datetime.datetime.now().year).isoformat()
-    except Exception as e:
-        print(f"Error fetching date: {e}")
-        return None
+        self.advance(events, ts)
 
+        if service_name:
+            record = Event(ts, (service_name, query, thread_key))
+            if self.attach_waiting(record):
+                events.append(record)
+                return
+            # A new record on the thread_key closes the one still open there
+            replaced = self.open.pop(thread_key, None)
+            if replaced is not None:
+                events.append(replaced)
+            self.open[thread_key] = record
+            self.hold(ts)
+        else:
+            record = self.open.get(thread_key)
+            if record is not None and self.pairs(record, ts):
+                record.values = (record.values[0], query, thread_key)
+                del self.open[thread_key]
+                events.append(record)
+            else:
+                self.waiting.setdefault(thread_key, []).append(Event(ts, ("", query, thread_key)))
+                self.hold(ts)
 
+    def hold(self, ts):
+        if self.oldest is None or ts < self.oldest:
+            self.oldest = ts
 
-# Keywords and command for zgrep
-oom_keywords = "OutOfMemoryMonitor"
-txsentry_keywords = "TxSentry"
-reference_data_processor_keywords = "ReferenceDataProcessorThread"
-expensive_rules_keywords = "Expensive Custom Rules Based On Average Throughput"
-too_many_open_files_keywords = "Too many open "
-cache_overflow_keywords = " is experiencing heavy "
-dropped_receive_keywords = "Dropped receive packets on interface "
-connect_localhost_keywords = "Unable to connect to server localhost:"
-log_path = "var/log/qradar.old/qradar.error.{25..1}.gz var/log/qradar.error"
-# HERE
-# BELOW
-cmd = f'zgrep -hE "{oom_keywords}|{txsentry_keywords}|{reference_data_processor_keywords}|{expensive_rules_keywords}|{too_many_open_files_keywords}|{cache_overflow_keywords}|{dropped_receive_keywords}|{connect_localhost_keywords}" {log_path} 2>/dev/null'
-
-# BELOW
-def process_logs(events_oom, events_txsentry, events_reference_data_processor, events_expensive_rules, events_too_many_open, events_cache_overflow, events_dropped_receive, events_connect_localhost, seen_events):
- 
-    issues_runs = os.popen(cmd).read().strip().split('\n')
-    last_event = None
-    for run in issues_runs:
-      
-        # OOM pattern check and processing
-        for pattern in oom_patterns:
-            match = pattern.search(run)
-            if match:
-                process_oom_event(match, events_oom, seen_events)
-                last_event = None
+    # A query is logged at the time of its record or up to expiry seconds after it
+    def pairs(self, record, ts):
+        return 0 <= ts - record.ts <= self.expiry
+
+    # Gives a new record the oldest query of its thread_key that was logged before it
+    def attach_waiting(self, record):
+        waiting = self.waiting.get(record.values[2])
+        if not waiting:
+            return False
+        for index, query_event in enumerate(waiting):
+            if self.pairs(record, query_event.ts):
+                record.values = (record.values[0], query_event.values[1], record.values[2])
+                del waiting[index]
+                if not waiting:
+                    del self.waiting[record.values[2]]
+                return True
+        return False
+
+    # Passes on, in time order, what no later line can change any more: the open records and
+    # the waiting queries older than oldest, or all of them at the end of a scan (oldest None)
+    def release(self, events, oldest=None):
+        closed = [record for record in self.open.values() if oldest is None or record.ts < oldest]
+        for record in closed:
+            del self.open[record.values[2]]
+        for thread_key in list(self.waiting):
+            waiting = self.waiting[thread_key]
+            expired = [query_event for query_event in waiting if oldest is None or query_event.ts < oldest]
+            if expired:
+                closed.extend(expired)
+                waiting[:] = [query_event for query_event in waiting if query_event.ts >= oldest] if oldest is not None else []
+            if not waiting:
+                del self.waiting[thread_key]
+        held = [record.ts for record in self.open.values()] + [query_event.ts for waiting in self.waiting.values() for query_event in waiting]
+        self.oldest = min(held, default=None)
+        closed.sort(key=operator.attrgetter('ts'))
+        for event in closed:
+            events.append(event)
+
+    def finish(self, events):
+        self.release(events)
+
+    # While following the live log, when it is quiet: what is expiry seconds older than the
+    # clock (now_ts, the log's wall-clock seconds)
+    def expire(self, events, now_ts):
+        self.advance(events, now_ts)
+        self.release(events, self.newest - self.expiry)
+
+# Longest a correlator holds an event back, in seconds of log time
+def correlator_hold():
+    return max([detector['correlator'].default_expiry for detector in detectors if 'correlator' in detector], default=0)
+
+# Handlers of one run by category: process_event, or the add method of the detector's
+# correlator, whose per-run state is returned too so it can be finished
+def new_handlers():
+    correlators = {detector['category']: detector['correlator']() for detector in detectors if 'correlator' in detector}
+    handlers = {detector['category']: correlators[detector['category']].add if detector['category'] in correlators else process_event
+                for detector in detectors}
+    return handlers, correlators
+
+def cache_overflow_message(groups):
+    return groups['cache'] + ' ' + groups['message'].strip()
+
+# Detector registry, in the order each line is checked. Adding an event type means adding its
+# pattern above and one entry here:
+#   category  - section name in the report
+#   literals  - a line is only tried against the patterns if it contains one of these
+#   patterns  - tried in order, the first match wins
+#   fields    - event fields taken from the match groups, or from derived[field](groups)
+#   key       - fields that, with the timestamp, identify duplicates
+#   interned  - fields with few distinct values (service, cache, interface), stored once
+#   rollup    - fields that, with the time bucket, group events for --rollup
+#   headers   - report columns
+#   correlator - optional class whose add() replaces process_event, for lines that pair up
+#   errors    - how the matched groups are decoded from the raw line (a codecs error handler,
+#               'ignore' by default); free text shown as is in the report uses 'replace'
+detectors = [
+    {
+        'category': 'OOM',
+        # The thread pattern has no OutOfMemoryMonitor in it
+        'literals': ("OutOfMemoryMonitor", "OutOfMemoryError"),
+        'patterns': oom_patterns,
+        'fields': ('service',),
+        'key': ('service',),
+        'interned': ('service',),
+        'rollup': ('service',),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}],
+    },
+    {
+        'category': 'TxSentry',
+        'literals': ("TxSentry",),
+        'patterns': txsentry_patterns,
+        'fields': ('service', 'query', 'thread_key'),
+        'key': ('service', 'query', 'thread_key'),
+        'rollup': ('service',),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}],
+        'correlator': TxSentryCorrelator,
+        'errors': 'replace',
+    },
+    {
+        'category': 'ReferenceDataProcessorThread',
+        'literals': ("ReferenceDataProcessorThread",),
+        'patterns': [reference_data_processor_thread_pattern],
+        'fields': ('message',),
+        'derived': {'message': lambda groups: 'We have crossed...'},
+        'key': (),
+        'rollup': (),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "message", "header": "Message"}],
+    },
+    {
+        'category': 'ExpensiveRules',
+        'literals': ("Expensive Custom Rules Based On Average Throughput",),
+        'patterns': [expensive_rules_pattern],
+        'fields': ('rules',),
+        'key': ('rules',),
+        'rollup': (),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "rules", "header": "Rules Details"}],
+        'errors': 'replace',
+    },
+    {
+        'category': 'TooManyOpenFiles',
+        'literals': ("Too many open ",),
+        'patterns': too_many_open_patterns,
+        'fields': ('service',),
+        'key': ('service',),
+        'interned': ('service',),
+        'rollup': ('service',),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}],
+    },
+    {
+        'category': 'CacheOverflow',
+        'literals': (" is experiencing heavy ",),
+        'patterns': cache_overflow_patterns,
+        'fields': ('service', 'cache', 'message'),
+        'derived': {'message': cache_overflow_message},
+        'key': ('service', 'cache', 'message'),
+        'interned': ('service', 'cache'),
+        'rollup': ('service', 'cache'),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}, {"key": "cache", "header": "Cache Name"}],
+    },
+    {
+        'category': 'DroppedReceive',
+        'literals': ("Dropped receive packets on interface ",),
+        'patterns': [dropped_receive_pattern],
+        'fields': ('interface', 'over_5_intervals', 'threshold'),
+        'key': ('interface',),
+        'interned': ('interface',),
+        'rollup': ('interface',),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "interface", "header": "Interface"}, {"key": "over_5_intervals", "header": "Over 5 Intervals"}, {"key": "threshold", "header": "Threshold"}],
+    },
+    {
+        'category': 'ConnectLocalhost',
+        'literals': ("Unable to connect to server localhost:",),
+        'patterns': [connect_localhost_pattern],
+        'fields': ('message', 'port'),
+        'derived': {'message': lambda groups: "Unable to connect to server localhost:"},
+        'key': ('port',),
+        'interned': ('port',),
+        'rollup': ('port',),
+        'headers': [{"key": "time_date", "header": "Time/Date"}, {"key": "message", "header": "Message"}, {"key": "port", "header": "Port"}],
+    },
+]
+detectors_by_category = {detector['category']: detector for detector in detectors}
+
+# Per-field value getters and key positions, worked out once from the registry for process_event
+def interning(getter):
+    return lambda groups: sys.intern(getter(groups))
+
+for detector in detectors:
+    getters = []
+    for field in detector['fields']:
+        getter = detector.get('derived', {}).get(field, operator.itemgetter(field))
+        getters.append(interning(getter) if field in detector.get('interned', ()) else getter)
+    detector['getters'] = tuple(getters)
+    detector['key_positions'] = tuple(detector['fields'].index(field) for field in detector['key'])
+    detector['rollup_positions'] = tuple(detector['fields'].index(field) for field in detector['rollup'])
+    detector['byte_patterns'] = [re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE) for pattern in detector['patterns']]
+    detector['errors'] = detector.get('errors', 'ignore')
+
+# Dispatch table built from the registry: every distinct literal once, with the positions of
+# the detectors it enables. A line pays one substring test per literal, and the regexes only
+# of the detectors whose literals it contains, however many detectors there are. Files are
+# read as raw bytes, so there is an encoded copy for the lines that are matched as bytes, and
+# its literals are the keywords searched for in the blocks read.
+def build_dispatch(detectors):
+    dispatch = {}
+    for index, detector in enumerate(detectors):
+        for literal in detector['literals']:
+            dispatch.setdefault(literal, []).append(index)
+    return [(literal, tuple(indexes)) for literal, indexes in dispatch.items()]
+
+dispatch = build_dispatch(detectors)
+byte_dispatch = [(literal.encode(), indexes) for literal, indexes in dispatch]
+keywords = [literal for literal, indexes in byte_dispatch]
+
+# Identifies the registry a checkpoint was written with, so a changed detector set rescans
+def detectors_signature():
+    parts = [(detector['category'], detector['literals'], [pattern.pattern for pattern in detector['patterns']], detector['errors']) for detector in detectors]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+# Rotated archives oldest first, then the live file, so lines come out in chronological order.
+# Paths are relative to the root of a host's extracted support bundle, by default the current
+# directory. Rotations are gzip by default, but logrotate can be set to bzip2 or xz.
+rotation_count = 25
+live_log = "var/log/qradar.error"
+archive_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def is_archive(path):
+    return path.endswith(tuple(archive_openers))
+
+def log_files(root=''):
+    paths = []
+    for n in range(rotation_count, 0, -1):
+        for suffix in archive_openers:
+            path = os.path.join(root, f"var/log/qradar.old/qradar.error.{n}{suffix}")
+            if os.path.exists(path):
+                paths.append(path)
                 break
-        
-        # TxSentry pattern check and processing
-        for pattern in txsentry_patterns:
-            match = pattern.search(run)
-            if match:
-                last_event = process_txsentry_event(match, events_txsentry, seen_events, last_event)
+    paths.append(os.path.join(root, live_log))
+    return [path for path in paths if os.path.exists(path)]
+
+# Profiling counters for --stats: per regex the lines tested, matched and time spent in
+# pattern.search, per detector the handler calls and time, and the time spent reading and
+# decompressing lines versus matching them. Only collected while the module-level stats is
+# set, so a normal run does not pay for the timers.
+class ScanStats:
+    def __init__(self):
+        self.total_seconds = 0.0
+        self.lines_read = 0
+        self.lines_matched_against = 0
+        self.read_seconds = 0.0
+        self.prefilter_seconds = 0.0
+        self.match_seconds = 0.0
+        self.patterns = {}
+        self.handlers = {}
+
+    def pattern_counter(self, detector, index):
+        counters = self.patterns.get(detector['category'])
+        if counters is None:
+            counters = self.patterns[detector['category']] = [[0, 0, 0.0] for pattern in detector['patterns']]
+        return counters[index]
+
+    def add_handler_time(self, category, seconds):
+        counter = self.handlers.setdefault(category, [0, 0.0])
+        counter[0] += 1
+        counter[1] += seconds
+
+    # Adds the counters of a scan done in a worker process or on one file
+    def merge(self, other):
+        self.lines_read += other.lines_read
+        self.lines_matched_against += other.lines_matched_against
+        self.read_seconds += other.read_seconds
+        self.prefilter_seconds += other.prefilter_seconds
+        self.match_seconds += other.match_seconds
+        for category, counters in other.patterns.items():
+            mine = self.patterns.setdefault(category, [[0, 0, 0.0] for counter in counters])
+            for total, counter in zip(mine, counters):
+                for i in range(3):
+                    total[i] += counter[i]
+        for category, (calls, seconds) in other.handlers.items():
+            counter = self.handlers.setdefault(category, [0, 0.0])
+            counter[0] += calls
+            counter[1] += seconds
+
+    def to_dict(self):
+        detectors_stats = {}
+        for detector in detectors:
+            category = detector['category']
+            calls, seconds = self.handlers.get(category, [0, 0.0])
+            detectors_stats[category] = {
+                "patterns": [{"pattern": pattern.pattern, "tested": tested, "matched": matched, "search_seconds": round(search_seconds, 6)}
+                             for pattern, (tested, matched, search_seconds) in zip(detector['patterns'], self.patterns.get(category, [[0, 0, 0.0]] * len(detector['patterns'])))],
+                "handler_calls": calls,
+                "handler_seconds": round(seconds, 6),
+            }
+        return {
+            "total_seconds": round(self.total_seconds, 6),
+            "lines_read": self.lines_read,
+            "lines_matched_against": self.lines_matched_against,
+            "read_seconds": round(self.read_seconds, 6),
+            "prefilter_seconds": round(self.prefilter_seconds, 6),
+            "match_seconds": round(self.match_seconds, 6),
+            "detectors": detectors_stats,
+        }
+
+    def write_table(self, out):
+        print(f"lines read: {self.lines_read}, with a literal: {self.lines_matched_against}", file=out)
+        print(f"total: {self.total_seconds:.3f}s, read/decompress: {self.read_seconds:.3f}s, keyword prefilter: {self.prefilter_seconds:.3f}s, matching: {self.match_seconds:.3f}s", file=out)
+        print(f"{'category':<30} {'#':>2} {'tested':>10} {'matched':>10} {'search s':>10} {'handler s':>10}", file=out)
+        for category, entry in self.to_dict()['detectors'].items():
+            for index, pattern in enumerate(entry['patterns']):
+                handler = f"{entry['handler_seconds']:>10.3f}" if index == 0 else ''
+                print(f"{category:<30} {index:>2} {pattern['tested']:>10} {pattern['matched']:>10} {pattern['search_seconds']:>10.3f} {handler}", file=out)
+
+stats = None
+
+# Decompression backends: each yields the decompressed content of a file in blocks of about
+# block_size bytes. For .gz a multithreaded external decompressor is used when one is on the
+# PATH (the first of gzip_commands), otherwise zlib in this process; .bz2 and .xz go through
+# the stdlib modules.
+gzip_commands = {'pigz': ['pigz', '-dc'], 'igzip': ['igzip', '-dc']}
+
+def stream_blocks(open_func, path, block_size=1 << 20):
+    with open_func(path, 'rb') as file:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                return
+            yield block
+
+# gzip streaming with zlib directly, reading the compressed file in large blocks. Output is
+# bounded per call, so a highly compressed flood does not come out in one huge block, and
+# concatenated gzip members are read one after the other as gzip does.
+def zlib_blocks(path, block_size=1 << 20):
+    with open(path, 'rb') as file:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        pending, in_member = b'', False
+        while True:
+            if not pending:
+                pending = file.read(block_size)
+                if not pending:
+                    break
+            block = decompressor.decompress(pending, block_size)
+            pending, in_member = decompressor.unconsumed_tail, True
+            if block:
+                yield block
+            if decompressor.eof:
+                pending = decompressor.unused_data.lstrip(b'\0')
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                in_member = False
+        if in_member:
+            block = decompressor.flush()
+            if block:
+                yield block
+            raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+
+# An external decompressor's output. Its failure on a corrupt archive raises OSError once the
+# data it did produce has been read, as the stdlib modules do.
+def command_blocks(command, path, block_size=1 << 20):
+    process = subprocess.Popen(command + [path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            block = process.stdout.read(block_size)
+            if not block:
+                break
+            yield block
+        error = process.stderr.read()
+        if process.wait() != 0:
+            raise OSError(f"{command[0]} exited with {process.returncode}: {error.decode('utf-8', errors='replace').strip()}")
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+decompressors = {
+    'zlib': zlib_blocks,
+    'bz2': functools.partial(stream_blocks, bz2.open),
+    'xz': functools.partial(stream_blocks, lzma.open),
+    'plain': functools.partial(stream_blocks, open),
+}
+for name, command in gzip_commands.items():
+    decompressors[name] = functools.partial(command_blocks, command)
+
+@functools.lru_cache(maxsize=None)
+def gzip_backend():
+    return next((name for name, command in gzip_commands.items() if shutil.which(command[0])), 'zlib')
+
+# Name of the backend used for a file
+def file_backend(path):
+    if path.endswith('.gz'):
+        return gzip_backend()
+    if path.endswith('.bz2'):
+        return 'bz2'
+    if path.endswith('.xz'):
+        return 'xz'
+    return 'plain'
+
+# Decompressed blocks of a file, adding the time spent reading and decompressing them and the
+# lines they hold to stats
+def read_blocks(path, backend=None):
+    blocks = decompressors[backend or file_backend(path)](path)
+    while True:
+        started = time.perf_counter() if stats is not None else None
+        block = next(blocks, None)
+        if stats is not None:
+            stats.read_seconds += time.perf_counter() - started
+        if block is None:
+            return
+        if stats is not None:
+            stats.lines_read += block.count(b'\n')
+        yield block
+
+# The raw lines of buffer[start:end] that contain any of the keywords, in order and without
+# their newline. Each keyword is searched over the whole buffer at once and only the lines
+# around its hits are cut out, so the lines without one, nearly all of them, are never split
+# off or decoded. end must be a line boundary or the end of the data.
+def keyword_lines(buffer, keywords, start=0, end=None):
+    end = len(buffer) if end is None else end
+    line_starts = set()
+    for keyword in keywords:
+        pos = buffer.find(keyword, start, end)
+        while pos >= 0:
+            line_starts.add(max(buffer.rfind(b'\n', start, pos) + 1, start))
+            line_end = buffer.find(b'\n', pos, end)
+            if line_end < 0:
                 break
-         
-        # Reference Data Processor Thread pattern check and processing
-        match = reference_data_processor_thread_pattern.search(run)
-        if match:
-            process_reference_data_processor_event(match, events_reference_data_processor, seen_events)
-            last_event = None
-          
-        # ExpensiveRules pattern check and processing
-        match = expensive_rules_pattern.search(run)
-        if match:
-            process_expensive_rules_event(match, events_expensive_rules, seen_events)
-            last_event = None 
-
-        # Too Many Open Files pattern check and processing
-        for pattern in too_many_open_patterns:
-            match = pattern.search(run)
+            pos = buffer.find(keyword, line_end, end)
+    for line_start in sorted(line_starts):
+        line_end = buffer.find(b'\n', line_start, end)
+        yield buffer[line_start:line_end if line_end >= 0 else end]
+
+# keyword_lines of buffer[start:end] as a list, adding the time taken to stats
+def prefiltered_lines(buffer, start=0, end=None):
+    if stats is None:
+        return list(keyword_lines(buffer, keywords, start, end))
+    started = time.perf_counter()
+    lines = list(keyword_lines(buffer, keywords, start, end))
+    stats.prefilter_seconds += time.perf_counter() - started
+    return lines
+
+# Streams the raw lines containing any of the keywords (what zgrep -hE used to print) of an
+# archive, one batch per decompressed block, so memory does not depend on how many lines
+# match. Only the lines with a keyword are cut out of a block, and only the groups of the
+# lines that match a detector are ever decoded. Batches come with None as the offset reached,
+# like those of read_live_lines.
+def read_archive_lines(path):
+    try:
+        partial = b''
+        for block in read_blocks(path):
+            block = partial + block
+            cut = block.rfind(b'\n') + 1
+            yield prefiltered_lines(block, 0, cut), None
+            partial = block[cut:]
+        yield prefiltered_lines(partial), None
+    except (OSError, EOFError, zlib.error, lzma.LZMAError) as e:
+        # A truncated or corrupt archive should not lose the other files, as with zgrep
+        print(f"Error reading {path}: {e}", file=sys.stderr)
+
+# Named groups of a match on a raw line, decoded with the detector's error policy. Optional
+# groups that did not take part stay None.
+def decode_groups(match, errors):
+    return {name: value.decode('utf-8', errors) if value is not None else None for name, value in match.groupdict().items()}
+
+# Returns the (category, groups) pairs for a raw line. Only the categories whose literal is
+# present get their regexes run, and the first matching pattern of a category wins. The named
+# groups are plain dicts of str so matches can be sent back from worker processes.
+# A line that is plain ASCII, as nearly all are, is decoded once and matched as text: that
+# cannot fail, and str substring tests are cheaper than bytes ones in CPython. Any other line
+# is matched as bytes and only its groups are decoded, with the detector's error policy.
+def match_line(line):
+    if stats is not None:
+        return match_line_profiled(line)
+    text = line.isascii()
+    if text:
+        line = line.decode('ascii')
+    candidates = set()
+    for literal, indexes in (dispatch if text else byte_dispatch):
+        if literal in line:
+            candidates.update(indexes)
+    matches = []
+    for index in sorted(candidates):
+        detector = detectors[index]
+        for pattern in detector['patterns' if text else 'byte_patterns']:
+            match = pattern.search(line)
             if match:
-                process_too_many_open_event(match, events_too_many_open, seen_events)
-                last_event = None
+                matches.append((detector['category'], match.groupdict() if text else decode_groups(match, detector['errors'])))
                 break
+    return matches
 
-        # Cache Overflow pattern check and processing
-        for pattern in cache_overflow_patterns:
-            match = pattern.search(run)
+# match_line with the --stats counters
+def match_line_profiled(line):
+    started = time.perf_counter()
+    text = line.isascii()
+    if text:
+        line = line.decode('ascii')
+    candidates = set()
+    for literal, indexes in (dispatch if text else byte_dispatch):
+        if literal in line:
+            candidates.update(indexes)
+    matches = []
+    for index in sorted(candidates):
+        detector = detectors[index]
+        for pattern_index, pattern in enumerate(detector['patterns' if text else 'byte_patterns']):
+            search_started = time.perf_counter()
+            match = pattern.search(line)
+            counter = stats.pattern_counter(detector, pattern_index)
+            counter[2] += time.perf_counter() - search_started
+            counter[0] += 1
             if match:
-                process_cache_overflow_event(match, events_cache_overflow, seen_events)
-                last_event = None
+                counter[1] += 1
+                matches.append((detector['category'], match.groupdict() if text else decode_groups(match, detector['errors'])))
                 break
+    stats.lines_matched_against += 1
+    stats.match_seconds += time.perf_counter() - started
+    return matches
 
-        # Dropped Receive pattern check and processing
-        match = dropped_receive_pattern.search(run)
-        if match:
-            process_dropped_receive_event(match, events_dropped_receive, seen_events)
-            last_event = None
-
-        # Connect Localhost pattern check and processing
-        match = connect_localhost_pattern.search(run)
-        if match:
-            process_connect_localhost_event(match, events_connect_localhost, seen_events)
-            last_event = None
-
-        #HERE
-
-# Define headers for the event types
-headers_oom = [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}]
-headers_txsentry = [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}]
-headers_reference_data_processor = [{"key": "time_date", "header": "Time/Date"}, {"key": "message", "header": "Message"}]
-headers_expensive_rules = [{"key": "time_date", "header": "Time/Date"}, {"key": "rules", "header": "Rules Details"}]
-headers_too_many_open = [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}]
-headers_cache_overflow = [{"key": "time_date", "header": "Time/Date"}, {"key": "service", "header": "Service Name"}, {"key": "cache", "header": "Cache Name"}]
-headers_dropped_receive = [{"key": "time_date", "header": "Time/Date"}, {"key": "interface", "header": "Interface"}, {"key": "over_5_intervals", "header": "Over 5 Intervals"}, {"key": "threshold", "header": "Threshold"}]
-headers_connect_localhost = [{"key": "time_date", "header": "Time/Date"}, {"key": "message", "header": "Message"}, {"key": "port", "header": "Port"}]
-# HERE
+# The raw lines with a keyword of the live (uncompressed) log from byte offset to end. The
+# file is memory-mapped and searched a window at a time in place (a window stays in the CPU
+# cache across the keyword searches), so nothing is copied and no object is made for a line
+# without a keyword: re-scanning from a saved offset runs close to I/O speed. Each window's
+# lines come with the offset after its last line. A last line without its newline is read as
+# it is; scan_logs_incremental, which resumes from the offset, stops at the last newline.
+def read_live_lines(path, offset=0, end=None, window=1 << 20):
+    with open(path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if end <= offset:
+            return
+        with mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ) as buffer:
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                buffer.madvise(mmap.MADV_SEQUENTIAL)
+            released = 0
+            while offset < end:
+                started = time.perf_counter() if stats is not None else None
+                stop = min(offset + window, end)
+                cut = buffer.rfind(b'\n', offset, stop) + 1
+                if cut <= offset:
+                    # A line longer than the window
+                    cut = buffer.find(b'\n', stop, end) + 1
+                    if cut == 0:
+                        cut = end
+                if stats is not None:
+                    # Counting the lines pages the window in, so the read time is taken here
+                    stats.lines_read += buffer[offset:cut].count(b'\n') + (buffer[cut - 1] != 10)
+                    stats.read_seconds += time.perf_counter() - started
+                yield prefiltered_lines(buffer, offset, cut), cut
+                offset = cut
+                # Unmap the pages searched so far, or a multi-GB file would all count as
+                # resident; they stay in the page cache
+                if hasattr(mmap, 'MADV_DONTNEED') and offset - released >= 64 * window:
+                    done = offset - offset % mmap.PAGESIZE
+                    buffer.madvise(mmap.MADV_DONTNEED, released, done - released)
+                    released = done
 
-def main():
-    events_oom = []
-    events_txsentry = []
-    events_reference_data_processor = []
-    events_expensive_rules = []
-    events_too_many_open = []
-    events_cache_overflow = []
-    events_dropped_receive = []
-    events_connect_localhost = []
-    # HERE
-    seen_events = set()
-    # BELOW
-    process_logs(events_oom, events_txsentry, events_reference_data_processor, events_expensive_rules, events_too_many_open, events_cache_overflow, events_dropped_receive, events_connect_localhost, seen_events)
-
-    # BELOW
-    for event_list, headers in [(events_oom, headers_oom), (events_txsentry, headers_txsentry), (events_reference_data_processor, headers_reference_data_processor), (events_expensive_rules, headers_expensive_rules), (events_too_many_open, headers_too_many_open), (events_cache_overflow, headers_cache_overflow), (events_dropped_receive, headers_dropped_receive), (events_connect_localhost, headers_connect_localhost)]:
-         event_list.sort(key=lambda event: event['DateTime'])
-         for idx, event in enumerate(event_list):
-             event['time_date'] = event['DateTime'].strftime("%m/%d %H:%M:%S")
-             event['id'] = str(idx)
-             del event['DateTime'] 
-             if 'thread_key' in event: 
-                 del event['thread_key']
-
-    #
-    start_date = fetch_date(start_date_cmd)
-    end_date = fetch_date(last_date_cmd)
-  
-    final_output = {
-        "metadata": {"start": start_date, "end": end_date},
-        "OOM": {"data": events_oom, "headers": headers_oom},
-        "TxSentry": {"data": events_txsentry, "headers": headers_txsentry},
-        "ReferenceDataProcessorThread": {"data": events_reference_data_processor, "headers": headers_reference_data_processor},
-        "ExpensiveRules": {"data": events_expensive_rules, "headers": headers_expensive_rules},
-        "TooManyOpenFiles": {"data": events_too_many_open, "headers": headers_too_many_open},
-        "CacheOverflow": {"data": events_cache_overflow, "headers": headers_cache_overflow},
-        "DroppedReceive": {"data": events_dropped_receive, "headers": headers_dropped_receive},
-        "ConnectLocalhost": {"data": events_connect_localhost, "headers": headers_connect_localhost}
-        # HERE
+# Batches of keyword lines of a log file, the live log read between byte offsets, each with
+# the offset reached
+def read_file_lines(path, offset=0, end=None):
+    if is_archive(path):
+        yield from read_archive_lines(path)
+        return
+    try:
+        yield from read_live_lines(path, offset, end)
+    except OSError as e:
+        print(f"Error reading {path}: {e}", file=sys.stderr)
+
+# Matches of batches of lines, with the last offset reached
+def match_batches(batches, offset=None):
+    hits = []
+    for lines, offset in batches:
+        for line in lines:
+            hits.extend(match_line(line))
+    return hits, offset
+
+# Reads (path, offset, end) work items in threads ahead of the caller, which gets an iterator
+# over the batches of each item in turn, as from read_file_lines. Decompression (zlib, bz2,
+# lzma and the pipe from pigz) releases the GIL, so it overlaps with the matching done by the
+# caller even without a process pool. Items are handed to the threads in order, and each has
+# a queue of at most queue_size batches: a thread that gets that far ahead of the caller waits,
+# which bounds memory to threads * queue_size blocks.
+def pipelined_lines(work, threads=1, queue_size=8):
+    queues = [queue.Queue(queue_size) for item in work]
+    items = iter(range(len(work)))
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def put(batch_queue, batch):
+        while not stop.is_set():
+            try:
+                batch_queue.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def reader():
+        while not stop.is_set():
+            with lock:
+                index = next(items, None)
+            if index is None:
+                return
+            try:
+                for batch in read_file_lines(*work[index]):
+                    if not put(queues[index], batch):
+                        return
+            except Exception as e:
+                put(queues[index], e)
+            put(queues[index], None)
+
+    def batches(batch_queue):
+        while True:
+            batch = batch_queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    readers = [threading.Thread(target=reader, daemon=True) for thread in range(min(threads, len(work)))]
+    for thread in readers:
+        thread.start()
+    try:
+        for batch_queue in queues:
+            yield batches(batch_queue)
+    finally:
+        stop.set()
+
+# Runs in a worker process: all (category, groups) matches of one log file, in line order,
+# and for the live log the byte offset to resume from. With collect_stats (--stats) the
+# counters of this file are collected apart and returned too, since a worker's own stats are
+# lost on exit; it is passed in rather than read from the global, which a worker only
+# inherits when the pool forks.
+def scan_file(path, offset=0, end=None, collect_stats=False):
+    global stats
+    outer_stats = stats
+    stats = ScanStats() if collect_stats else None
+    try:
+        hits, offset = match_batches(read_file_lines(path, offset, end), None if is_archive(path) else offset)
+    finally:
+        file_stats, stats = stats, outer_stats
+    return hits, offset, file_stats
+
+# Offset of the first line starting at or after pos
+def line_start_after(file, pos):
+    if pos <= 0:
+        return 0
+    file.seek(pos - 1)
+    file.readline()
+    return file.tell()
+
+# Cuts the byte range of an uncompressed log into up to jobs (path, offset, end) pieces of at
+# least split_size bytes, each starting at a line, so that one huge live log is matched by
+# several workers. A line never straddles two pieces.
+split_size = 64 << 20
+
+def split_range(path, offset=0, end=None, jobs=1):
+    try:
+        with open(path, 'rb') as file:
+            stop = os.fstat(file.fileno()).st_size if end is None else end
+            count = min(jobs, (stop - offset) // split_size)
+            bounds = [offset]
+            for index in range(1, count):
+                bound = line_start_after(file, offset + (stop - offset) * index // count)
+                if bounds[-1] < bound < stop:
+                    bounds.append(bound)
+    except OSError:
+        return [(path, offset, end)]
+    return [(path, start, next_start) for start, next_start in zip(bounds, bounds[1:] + [end])]
+
+# Scans (path, offset, end) work items serially or in a process pool, results in the same
+# order as (hits, offset) pairs. With jobs > 1 large uncompressed ranges are split with
+# split_range; the hits of the pieces are joined back in file order, and the offset reached
+# is that of the last piece, so the caller replays them (dedup, TxSentry pairing across the
+# seams) exactly as if the file had been scanned in one go. Otherwise, with threads > 0 (and
+# no --stats, which times reading and matching apart) the files are read by pipelined_lines.
+def scan_files(work, jobs=1, threads=0):
+    pieces = [split_range(*item, jobs) if jobs > 1 and not is_archive(item[0]) else [item] for item in work]
+    flat = [piece for item_pieces in pieces for piece in item_pieces]
+    if jobs > 1 and len(flat) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = iter(pool.map(scan_file, *zip(*flat), itertools.repeat(stats is not None)))
+    elif threads > 0 and stats is None:
+        results = ((*match_batches(batches, None if is_archive(path) else offset), None)
+                   for (path, offset, end), batches in zip(flat, pipelined_lines(flat, threads)))
+    else:
+        results = (scan_file(path, offset, end, stats is not None) for path, offset, end in flat)
+    joined = []
+    for item_pieces in pieces:
+        item_hits = []
+        for piece in item_pieces:
+            hits, offset, file_stats = next(results)
+            item_hits.extend(hits)
+            if file_stats is not None:
+                stats.merge(file_stats)
+        joined.append((item_hits, offset))
+    return joined
+
+# Checkpoint of already scanned logs. The state file only holds the index: the identity and
+# number of matches of every rotated archive, the inode, byte offset reached and size of the
+# matches of the live log, and the first timestamp of each archive. The matches themselves
+# are in a directory next to it, one NDJSON file per archive and one for the live log, so a
+# refresh streams them back a line at a time and only writes the files of new archives and
+# what was added to the live log. Rotation renames an archive (.1.gz -> .2.gz) without
+# changing its inode, size or mtime, so it stays cached.
+state_version = 2
+
+def file_identity(path):
+    st = os.stat(path)
+    return f"{st.st_ino}:{st.st_size}:{st.st_mtime_ns}"
+
+def load_state(path):
+    try:
+        with open(path) as file:
+            state = json.load(file)
+    except (OSError, ValueError):
+        state = {}
+    if state.get('version') != state_version or state.get('detectors') != detectors_signature():
+        state = {}
+    state['hits_dir'] = path + '.d'
+    return state
+
+def save_state(path, state):
+    state['version'] = state_version
+    state['detectors'] = detectors_signature()
+    archives = state.get('archives', {})
+    state['first_timestamps'] = {identity: ts for identity, ts in state.get('first_timestamps', {}).items() if identity in archives}
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump({key: value for key, value in state.items() if key != 'hits_dir'}, file)
+    os.replace(tmp_path, path)
+    # Matches of archives that were rotated away
+    hits_dir = state['hits_dir']
+    keep = {os.path.basename(hits_path(state, identity)) for identity in archives} | {os.path.basename(hits_path(state, 'live'))}
+    for name in os.listdir(hits_dir) if os.path.isdir(hits_dir) else []:
+        if name not in keep:
+            os.remove(os.path.join(hits_dir, name))
+
+# File of the checkpointed matches of an archive identity, or of 'live'
+def hits_path(state, name):
+    return os.path.join(state['hits_dir'], name.replace(':', '-') + '.ndjson')
+
+def read_hits(path):
+    with open(path) as file:
+        for line in file:
+            category, groups = json.loads(line)
+            yield category, groups
+
+def write_hits(file, hits):
+    for hit in hits:
+        file.write(json.dumps(hit) + '\n')
+
+# Offset after the last newline of a file: a last line without one may still be being
+# written, so a scan that is resumed from its offset stops there and reads it next time
+def last_line_end(path):
+    with open(path, 'rb') as file:
+        pos = os.fstat(file.fileno()).st_size
+        while pos > 0:
+            start = max(pos - (1 << 16), 0)
+            file.seek(start)
+            cut = file.read(pos - start).rfind(b'\n')
+            if cut >= 0:
+                return start + cut + 1
+            pos = start
+    return 0
+
+# Matches of the files in file order, taking what it can from the checkpoint and scanning
+# only new archives and the part of the live log written since the last run, up to its last
+# complete line. The state dict is updated in place with the current archives and live
+# offset, and the matches of what was scanned are added to the checkpoint's files.
+def scan_logs_incremental(paths, state, jobs=1, threads=0):
+    os.makedirs(state['hits_dir'], exist_ok=True)
+    cached_archives = state.get('archives', {})
+    cached_live = state.get('live', {})
+    live_path = hits_path(state, 'live')
+    archives = {}
+    plan = []
+    work = []
+    for path in paths:
+        if is_archive(path):
+            identity = file_identity(path)
+            if identity in cached_archives and os.path.exists(hits_path(state, identity)):
+                archives[identity] = cached_archives[identity]
+                plan.append((path, identity, True, False))
+                continue
+            plan.append((path, identity, False, True))
+            work.append((path, 0, None))
+        else:
+            st = os.stat(path)
+            identity = st.st_ino
+            offset = cached_live.get('offset', 0)
+            hits_size = cached_live.get('hits_size', 0)
+            if cached_live.get('inode') == identity and offset <= st.st_size and os.path.exists(live_path) and os.path.getsize(live_path) >= hits_size:
+                # Drop what a run that did not get to save the state added
+                os.truncate(live_path, hits_size)
+                plan.append((path, identity, True, True))
+                work.append((path, offset, last_line_end(path)))
+            else:
+                # New live file after a rotation, or truncated: start over
+                open(live_path, 'w').close()
+                plan.append((path, identity, False, True))
+                work.append((path, 0, last_line_end(path)))
+
+    results = iter(scan_files(work, jobs, threads))
+    state.pop('live', None)
+    for path, identity, cached, scanned in plan:
+        if cached:
+            yield from read_hits(hits_path(state, 'live' if scanned else identity))
+        if not scanned:
+            continue
+        hits, offset = next(results)
+        if offset is None:
+            tmp_path = hits_path(state, identity) + '.tmp'
+            with open(tmp_path, 'w') as file:
+                write_hits(file, hits)
+            os.replace(tmp_path, hits_path(state, identity))
+            archives[identity] = len(hits)
+        else:
+            with open(live_path, 'a') as file:
+                write_hits(file, hits)
+                hits_size = file.tell()
+            state['live'] = {'inode': identity, 'offset': offset, 'hits_size': hits_size}
+        yield from hits
+    state['archives'] = archives
+
+# Yields the matches of all files in file order. With jobs > 1 every file is decompressed and
+# matched in its own worker (a large live log in several byte ranges), and the results are
+# handed back in the same order as a serial scan, so the dedup and TxSentry merging done by
+# the caller do not change. With a state dict from load_state() only what changed since the
+# checkpoint is scanned; otherwise the live log is read between the live_range byte offsets.
+# A serial scan streams the matches; with threads > 0 the files are read ahead by that many
+# threads (pipelined_lines) while this one matches.
+def scan_logs(paths, jobs=1, state=None, live_range=(0, None), threads=0):
+    work = [(path, 0, None) if is_archive(path) else (path, *live_range) for path in paths]
+    if state is not None:
+        yield from scan_logs_incremental(paths, state, jobs, threads)
+    elif jobs > 1:
+        for hits, offset in scan_files(work, jobs):
+            yield from hits
+    else:
+        files = pipelined_lines(work, threads) if threads > 0 and stats is None else (read_file_lines(*item) for item in work)
+        for batches in files:
+            for lines, offset in batches:
+                for line in lines:
+                    yield from match_line(line)
+
+# Time windows (--since/--until), in the same epoch seconds as parse_syslog_date
+line_date_pattern = re.compile(r'(\w{3}\s+\d+\s+\d+:\d+:\d+)')
+
+# None for a line without a date, or with a date-shaped start that is not one (Tue 12 10:00:00)
+def line_timestamp(line):
+    match = line_date_pattern.match(line)
+    if not match:
+        return None
+    try:
+        return parse_syslog_date(match.group(1))
+    except (KeyError, ValueError):
+        return None
+
+# Timestamp of the first dated line among the first lines of a file; for an archive only the
+# beginning is decompressed. Archives never change, so with a cache dict (kept in the
+# checkpoint) their value is looked up by file identity instead.
+def first_timestamp(path, cache=None, max_lines=200):
+    identity = file_identity(path) if cache is not None and is_archive(path) else None
+    if identity in (cache or {}):
+        return cache[identity]
+    ts = None
+    open_func = archive_openers.get(os.path.splitext(path)[1], open)
+    try:
+        with open_func(path, 'rt', encoding='utf-8', errors='ignore') as file:
+            for line_number, line in enumerate(file):
+                if line_number >= max_lines:
+                    break
+                ts = line_timestamp(line)
+                if ts is not None:
+                    break
+    except (OSError, EOFError, KeyError, ValueError, lzma.LZMAError):
+        pass
+    if identity is not None:
+        cache[identity] = ts
+    return ts
+
+# Timestamp of the last dated line, reading the file backwards from the end a block at a time
+def last_timestamp(path, block_size=65536, max_bytes=1 << 20):
+    try:
+        with open(path, 'rb') as file:
+            pos = end = file.seek(0, os.SEEK_END)
+            partial = b''
+            while pos > 0 and end - pos < max_bytes:
+                size = min(block_size, pos)
+                pos -= size
+                file.seek(pos)
+                lines = (file.read(size) + partial).split(b'\n')
+                # The first piece continues a line that starts before this block
+                partial = lines.pop(0) if pos > 0 else b''
+                for raw_line in reversed(lines):
+                    ts = line_timestamp(raw_line.decode('utf-8', errors='ignore'))
+                    if ts is not None:
+                        return ts
+    except OSError:
+        pass
+    return None
+
+# Report start and end: the first date of the oldest file and the last date of the live log
+# (or the newest file), found without spawning any process
+def report_dates(paths, cache=None):
+    start = first_timestamp(paths[0], cache) if paths else None
+    end = last_timestamp(paths[-1]) if paths and not is_archive(paths[-1]) else None
+    return {
+        "start": epoch_to_datetime(start).isoformat() if start is not None else None,
+        "end": epoch_to_datetime(end).isoformat() if end is not None else None,
     }
-    
-    print(json.dumps(final_output))
+
+# Drops the files lying entirely outside [since, until]. A file ends where the next newer one
+# begins, so first timestamps are enough to bound every archive without decompressing it.
+def files_in_window(paths, since=None, until=None, cache=None):
+    firsts = [first_timestamp(path, cache) for path in paths]
+    selected = []
+    for index, path in enumerate(paths):
+        start = firsts[index]
+        end = firsts[index + 1] if index + 1 < len(paths) else None
+        if since is not None and end is not None and end < since:
+            continue
+        if until is not None and start is not None and start > until:
+            continue
+        selected.append(path)
+    return selected
+
+# Offset and timestamp of the first dated line starting at or after pos
+def next_dated_line(file, pos):
+    if pos > 0:
+        file.seek(pos - 1)
+        file.readline()
+    else:
+        file.seek(0)
+    while True:
+        start = file.tell()
+        raw_line = file.readline()
+        if not raw_line:
+            return start, None
+        ts = line_timestamp(raw_line.decode('utf-8', errors='ignore'))
+        if ts is not None:
+            return start, ts
+
+# Binary search of the live log for the offset of the first line dated ts or later
+def find_offset(path, ts):
+    with open(path, 'rb') as file:
+        low, high = 0, os.fstat(file.fileno()).st_size
+        while low < high:
+            mid = (low + high) // 2
+            start, line_ts = next_dated_line(file, mid)
+            if line_ts is None or line_ts >= ts:
+                high = mid
+            else:
+                low = start + 1
+        return next_dated_line(file, low)[0]
+
+# --since/--until values: an ISO date and time, or a span back from now such as 90m, 24h or 7d
+def parse_time_arg(value):
+    match = re.fullmatch(r'(\d+)([smhd])', value)
+    if match:
+        return run_now_ts - int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    return calendar.timegm(datetime.datetime.fromisoformat(value).timetuple())
+
+# Report row for an event; thread_key is only used to pair TxSentry lines and is left out
+def event_to_dict(detector, event, idx):
+    row = {'host': event.host} if isinstance(event, HostEvent) else {}
+    row.update((field, value) for field, value in zip(detector['fields'], event.values) if field != 'thread_key')
+    row['time_date'] = epoch_to_datetime(event.ts).strftime("%m/%d %H:%M:%S")
+    row['id'] = str(idx)
+    return row
+
+# Set-like dedup keys. Duplicates only come from the same line read twice (rotated content
+# overlapping), which has the same timestamp and turns up close to the first copy, so keys
+# are kept for two generations of window seconds of log time rather than for the whole run:
+# memory follows the number of events in the window, not in the logs. advance() is called with
+# each line's timestamp before its handler. A line dated more than a window before what was
+# already seen means the input is not in time order; from then on, as with window None, no
+# key is forgotten.
+class RecentKeys:
+    def __init__(self, window=None):
+        self.window = window or None
+        self.current = set()
+        self.previous = set()
+        self.generation_start = None
+
+    def advance(self, ts):
+        if self.window is None:
+            return
+        if self.generation_start is None:
+            self.generation_start = ts
+        elif ts - self.generation_start >= self.window:
+            self.previous = self.current if ts - self.generation_start < 2 * self.window else set()
+            self.current = set()
+            self.generation_start = ts
+        elif ts < self.generation_start - self.window:
+            self.window = None
+
+    def __contains__(self, key):
+        return key in self.current or key in self.previous
+
+    def add(self, key):
+        self.current.add(key)
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+# Runs the handlers over the matches of the logs under root, in log order. seen_events is a
+# RecentKeys shared by all categories.
+def process_logs(events, seen_events, jobs=1, state=None, since=None, until=None, root='', threads=0):
+    paths = log_files(root)
+    live_range = (0, None)
+    if since is not None or until is not None:
+        paths = files_in_window(paths, since, until, state.setdefault('first_timestamps', {}) if state is not None else None)
+        if paths and not is_archive(paths[-1]):
+            live_range = (find_offset(paths[-1], since) if since is not None else 0,
+                          find_offset(paths[-1], until + 1) if until is not None else None)
+
+    handlers, correlators = new_handlers()
+    for category, groups in scan_logs(paths, jobs, state, live_range, threads):
+        ts = parse_syslog_date(groups['date'])
+        if ts is None or (since is not None and ts < since) or (until is not None and ts > until):
+            continue
+        seen_events.advance(ts)
+        for correlated, correlator in correlators.items():
+            correlator.advance(events[correlated], ts)
+        detector = detectors_by_category[category]
+        if stats is None:
+            handlers[category](detector, groups, events[category], seen_events)
+        else:
+            started = time.perf_counter()
+            handlers[category](detector, groups, events[category], seen_events)
+            stats.add_handler_time(category, time.perf_counter() - started)
+    for category, correlator in correlators.items():
+        correlator.finish(events[category])
+
+# Running per-bucket counts for --rollup: for each category, the number of events and the
+# first and last time seen per (time bucket, rollup fields). Memory grows with the number of
+# distinct keys and buckets, not with the number of events. Key values are stripped, as some
+# patterns capture a service with a trailing space ('ecs-ec ') and it is one service.
+class Rollup:
+    def __init__(self, bucket_seconds):
+        self.bucket_seconds = bucket_seconds
+        self.counts = {detector['category']: {} for detector in detectors}
+
+    def add(self, detector, event):
+        bucket = event.ts - event.ts % self.bucket_seconds
+        key = (bucket, tuple([event.values[position].strip() if event.values[position] else event.values[position]
+                              for position in detector['rollup_positions']]))
+        counts = self.counts[detector['category']]
+        entry = counts.get(key)
+        if entry is None:
+            counts[key] = [1, event.ts, event.ts]
+        else:
+            entry[0] += 1
+            entry[1] = min(entry[1], event.ts)
+            entry[2] = max(entry[2], event.ts)
+
+    def rows(self, detector):
+        counts = self.counts[detector['category']]
+        for idx, key in enumerate(sorted(counts)):
+            bucket, values = key
+            count, first_seen, last_seen = counts[key]
+            row = dict(zip(detector['rollup'], values))
+            row['bucket'] = epoch_to_datetime(bucket).strftime("%m/%d %H:%M:%S")
+            row['count'] = count
+            row['first_seen'] = epoch_to_datetime(first_seen).strftime("%m/%d %H:%M:%S")
+            row['last_seen'] = epoch_to_datetime(last_seen).strftime("%m/%d %H:%M:%S")
+            row['id'] = str(idx)
+            yield row
+
+def rollup_headers(detector):
+    return ([{"key": "bucket", "header": "Time Bucket"}]
+            + [header for header in detector['headers'] if header['key'] in detector['rollup']]
+            + [{"key": "count", "header": "Count"}, {"key": "first_seen", "header": "First Seen"}, {"key": "last_seen", "header": "Last Seen"}])
+
+# Stands in for a category's event list in process_logs, counting every event into the rollup
+# before passing it on to the real list or writer, if any
+class RollupEvents:
+    __slots__ = ('events', 'rollup', 'detector')
+
+    def __init__(self, events, rollup, detector):
+        self.events = events
+        self.rollup = rollup
+        self.detector = detector
+
+    def append(self, event):
+        self.rollup.add(self.detector, event)
+        if self.events is not None:
+            self.events.append(event)
+
+# Writes the report in the {"metadata": ..., "OOM": {"data": [...], "headers": [...]}, ...}
+# shape one row at a time, so the rows and the serialized report never exist in full. With a
+# rollup each category also gets a "rollup": {"data": [...], "headers": [...]} entry.
+def write_json_report(out, metadata, events, rollup=None, host_column=False):
+    out.write('{"metadata": ' + json.dumps(metadata))
+    for detector in detectors:
+        out.write(', ' + json.dumps(detector['category']) + ': {"data": [')
+        for idx, event in enumerate(events.get(detector['category'], ())):
+            if idx:
+                out.write(', ')
+            out.write(json.dumps(event_to_dict(detector, event, idx)))
+        headers = detector['headers']
+        if host_column:
+            headers = headers[:1] + [{"key": "host", "header": "Host"}] + headers[1:]
+        out.write('], "headers": ' + json.dumps(headers))
+        if rollup is not None:
+            out.write(', "rollup": {"data": [')
+            for idx, row in enumerate(rollup.rows(detector)):
+                if idx:
+                    out.write(', ')
+                out.write(json.dumps(row))
+            out.write('], "headers": ' + json.dumps(rollup_headers(detector)) + '}')
+        out.write('}')
+    out.write('}\n')
+
+# NDJSON output written while the scan runs: one event per line with its category, in the
+# order given (time order behind a Reorder, log order in --follow), ids counted per category.
+# TxSentry records only reach it once their query is attached, so nothing is held back here.
+class NdjsonWriter:
+    def __init__(self, out):
+        self.out = out
+        self.ids = {}
+
+    def write(self, row):
+        self.out.write(json.dumps(row) + '\n')
+
+    def append(self, detector, event):
+        idx = self.ids.get(detector['category'], 0)
+        self.ids[detector['category']] = idx + 1
+        row = {'category': detector['category']}
+        row.update(event_to_dict(detector, event, idx))
+        self.write(row)
+
+# Stands in for a category's event list in process_logs, sending appended events to the writer
+class NdjsonEvents:
+    __slots__ = ('writer', 'detector')
+
+    def __init__(self, writer, detector):
+        self.writer = writer
+        self.detector = detector
+
+    def append(self, event):
+        self.writer.append(self.detector, event)
+
+# Optional SQLite history of events (--store), so runs can be queried after the rotated
+# archives holding them are gone. One table per category with the host, the epoch seconds and
+# the detector's fields, indexed on time, host and service. Every run rescans the same logs,
+# so a unique index on (host, ts, key fields) makes re-inserting an event a no-op. Services
+# are stored stripped: some patterns capture the space before "(type java)", and --service
+# and --count-by service must see one name.
+store_version = 1
+
+class EventStore:
+    def __init__(self, path, batch_size=10000):
+        self.connection = sqlite3.connect(path)
+        self.batch_size = batch_size
+        self.pending = {detector['category']: [] for detector in detectors}
+        for detector in detectors:
+            table = store_table(detector)
+            columns = ', '.join(f'"{field}" TEXT' for field in detector['fields'])
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (host TEXT NOT NULL, ts INTEGER NOT NULL, {columns})')
+            unique = ', '.join(['host', 'ts'] + [f'"{field}"' for field in detector['key']])
+            self.connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{detector["category"]}_key" ON {table} ({unique})')
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{detector["category"]}_ts" ON {table} (ts)')
+            self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{detector["category"]}_host" ON {table} (host, ts)')
+            if 'service' in detector['fields']:
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS "{detector["category"]}_service" ON {table} (service, ts)')
+        if self.connection.execute('PRAGMA user_version').fetchone()[0] < store_version:
+            # Stores written before services were stripped: a row whose stripped twin is
+            # already there is a duplicate
+            for detector in detectors:
+                if 'service' in detector['fields']:
+                    table = store_table(detector)
+                    self.connection.execute(f'UPDATE OR IGNORE {table} SET service = trim(service, {store_whitespace}) WHERE service != trim(service, {store_whitespace})')
+                    self.connection.execute(f'DELETE FROM {table} WHERE service != trim(service, {store_whitespace})')
+            self.connection.execute(f'PRAGMA user_version = {store_version}')
+        self.connection.commit()
+
+    def add(self, detector, event, host=''):
+        pending = self.pending[detector['category']]
+        pending.append((host, event))
+        if len(pending) >= self.batch_size:
+            self.insert(detector, pending)
+            pending.clear()
+
+    def insert(self, detector, rows):
+        placeholders = ', '.join('?' * (len(detector['fields']) + 2))
+        service = detector['fields'].index('service') if 'service' in detector['fields'] else None
+        values = [tuple(event.values) for host, event in rows]
+        if service is not None:
+            values = [row[:service] + (row[service].strip(),) + row[service + 1:] for row in values]
+        with self.connection:
+            self.connection.executemany(f'INSERT OR IGNORE INTO {store_table(detector)} VALUES ({placeholders})',
+                                        [(host, event.ts) + row for (host, event), row in zip(rows, values)])
+
+    def flush(self):
+        for detector in detectors:
+            pending = self.pending[detector['category']]
+            if pending:
+                self.insert(detector, pending)
+                pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# What str.strip() removes from a service name, for trim() in SQL
+store_whitespace = "' ' || char(9, 10, 11, 12, 13)"
+
+def store_table(detector):
+    return '"' + detector['category'] + '"'
+
+# Stands in for a category's event list in process_logs, adding every event to the store
+# before passing it on
+class StoreEvents:
+    __slots__ = ('events', 'store', 'detector')
+
+    def __init__(self, events, store, detector):
+        self.events = events
+        self.store = store
+        self.detector = detector
+
+    def append(self, event):
+        self.store.add(self.detector, event)
+        if self.events is not None:
+            self.events.append(event)
+
+# Passes a merged multi-host event stream through, adding each event to the store
+def store_events(store, detector, events):
+    for event in events:
+        store.add(detector, event, event.host)
+        yield event
+
+# --query: events of one category from the store, oldest first, or with count_by a count per
+# group of fields, host, day, hour or month
+store_periods = {'day': '%Y-%m-%d', 'hour': '%Y-%m-%dT%H:00', 'month': '%Y-%m'}
+
+def query_store(path, category, service=None, host=None, since=None, until=None, count_by=()):
+    detector = detectors_by_category[category]
+    conditions, parameters = [], []
+    for column, value in (('service', service), ('host', host)):
+        if value is not None:
+            conditions.append(f'"{column}" = ?')
+            parameters.append(value)
+    if since is not None:
+        conditions.append('ts >= ?')
+        parameters.append(since)
+    if until is not None:
+        conditions.append('ts <= ?')
+        parameters.append(until)
+    where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+    # Read-only, so a mistyped path is an error rather than a new empty store
+    connection = sqlite3.connect(f'file:{urllib.parse.quote(path)}?mode=ro', uri=True)
+    try:
+        if count_by:
+            groups = [f"strftime('{store_periods[name]}', ts, 'unixepoch')" if name in store_periods else f'"{name}"' for name in count_by]
+            cursor = connection.execute(f'SELECT {", ".join(groups)}, count(*) FROM {store_table(detector)}{where} '
+                                        f'GROUP BY {", ".join(groups)} ORDER BY {", ".join(groups)}', parameters)
+            return [dict(zip(list(count_by) + ['count'], row)) for row in cursor]
+        fields = [field for field in detector['fields'] if field != 'thread_key']
+        columns = ', '.join(f'"{field}"' for field in fields)
+        cursor = connection.execute(f'SELECT host, ts, {columns} FROM {store_table(detector)}{where} ORDER BY ts', parameters)
+        rows = []
+        for row in cursor:
+            result = {'host': row[0]} if row[0] else {}
+            result.update(zip(fields, row[2:]))
+            result['time'] = epoch_to_datetime(row[1]).isoformat()
+            rows.append(result)
+        return rows
+    finally:
+        connection.close()
+
+# Host label of each bundle root: its directory name, or the whole path when two roots share one
+def host_names(roots):
+    names = [os.path.basename(os.path.normpath(root)) for root in roots]
+    return [name if names.count(name) == 1 else os.path.normpath(root) for name, root in zip(names, roots)]
+
+# Runs in a worker process in multi-host runs: the report dates and time-ordered events of one
+# support bundle, each tagged with its host. Dedup and TxSentry merging stay within the host.
+def scan_host(root, host, since=None, until=None, jobs=1, dedup_window=None, reorder_window=300, threads=0):
+    events = {detector['category']: [] for detector in detectors}
+    reorder = Reorder(reorder_window, lambda detector, event: events[detector['category']].append(HostEvent(event.ts, event.values, host)))
+    process_logs({detector['category']: ReorderEvents(reorder, detector) for detector in detectors}, RecentKeys(dedup_window), jobs, None, since, until, root, threads)
+    reorder.flush()
+    if reorder.late:
+        for event_list in events.values():
+            event_list.sort(key=lambda event: event.ts)
+    return report_dates(log_files(root)), events
+
+# Scans the (root, host) bundles, one per worker process with jobs > 1, otherwise one after
+# the other with jobs used for the files of each bundle
+def scan_hosts(hosts, since=None, until=None, jobs=1, dedup_window=None, reorder_window=300, threads=0):
+    if jobs > 1 and len(hosts) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(scan_host, root, host, since, until, 1, dedup_window, reorder_window, threads) for root, host in hosts]
+            return [future.result() for future in futures]
+    return [scan_host(root, host, since, until, jobs, dedup_window, reorder_window, threads) for root, host in hosts]
+
+# One timeline from the per-host results: every category's events k-way merged by time (equal
+# times keep the order of the roots), and metadata spanning all hosts plus each host's own dates
+def merge_hosts(hosts, results):
+    host_dates = {host: dates for (root, host), (dates, events) in zip(hosts, results)}
+    starts = [dates['start'] for dates in host_dates.values() if dates['start'] is not None]
+    ends = [dates['end'] for dates in host_dates.values() if dates['end'] is not None]
+    metadata = {"start": min(starts, default=None), "end": max(ends, default=None), "hosts": host_dates}
+    events = {detector['category']: heapq.merge(*[host_events[detector['category']] for dates, host_events in results], key=operator.attrgetter('ts'))
+              for detector in detectors}
+    return metadata, events
+
+# Complete raw lines appended to the live log from offset on, forever. None is yielded each time
+# the reader has caught up, before sleeping poll_interval seconds. When the file is rotated
+# (a new inode at path) the rest of the old one is read from the still open handle first;
+# when it is truncated in place (copytruncate) reading starts over from the beginning.
+def follow_lines(path, offset=None, poll_interval=1.0):
+    file = None
+    while True:
+        if file is None:
+            try:
+                file = open(path, 'rb')
+            except FileNotFoundError:
+                yield None
+                time.sleep(poll_interval)
+                continue
+            inode = os.fstat(file.fileno()).st_ino
+            if offset is None:
+                offset = os.fstat(file.fileno()).st_size
+            file.seek(offset)
+
+        raw_line = file.readline()
+        if raw_line.endswith(b'\n'):
+            offset += len(raw_line)
+            yield raw_line.rstrip(b'\n')
+            continue
+        # Caught up, possibly in the middle of a line still being written
+        file.seek(offset)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None and st.st_ino != inode:
+            for raw_line in file:
+                if raw_line.endswith(b'\n'):
+                    yield raw_line.rstrip(b'\n')
+            file.close()
+            file, offset = None, 0
+            continue
+        if st is not None and st.st_size < offset:
+            offset = 0
+            file.seek(0)
+            continue
+        yield None
+        time.sleep(poll_interval)
+
+# --follow: matches lines as they are appended to the live log and writes each new event to
+# the NDJSON writer. Whenever the reader catches up the output is flushed; a TxSentry record
+# is only written once its query line has come, or expiry seconds later by the clock.
+def follow_logs(path, events, seen_events, writer, offset=None, poll_interval=1.0, store=None):
+    handlers, correlators = new_handlers()
+    try:
+        for line in follow_lines(path, offset, poll_interval):
+            if line is None:
+                now_ts = calendar.timegm(datetime.datetime.now().timetuple())
+                for category, correlator in correlators.items():
+                    correlator.expire(events[category], now_ts)
+                writer.out.flush()
+                if store is not None:
+                    store.flush()
+                now = datetime.datetime.now()
+                if now.date() != run_now.date():
+                    set_run_now(now)
+                continue
+            if not any(keyword in line for keyword in keywords):
+                continue
+            for category, groups in match_line(line):
+                detector = detectors_by_category[category]
+                ts = parse_syslog_date(groups['date'])
+                if ts is None:
+                    continue
+                seen_events.advance(ts)
+                for correlated, correlator in correlators.items():
+                    correlator.advance(events[correlated], ts)
+                handlers[category](detector, groups, events[category], seen_events)
+    finally:
+        # Stopped (Ctrl-C): records still waiting for their query are written as they are
+        for category, correlator in correlators.items():
+            correlator.finish(events[category])
+
+# Puts the events of all categories back in time order while the scan runs. Logs are read
+# oldest file first and each file is in time order except for lines logged a little late, so
+# an event is held only until the newest timestamp seen is window seconds past it, then passed
+# to emit(detector, event). Equal timestamps keep log order, as the stable sort did. Events in
+# order are queued at the end of a deque; only the few out of order go through a heap. late
+# counts the events that still arrived after a newer one was passed on. The window is never
+# shorter than correlator_hold(), or a TxSentry record held back until its query came would
+# count as late.
+class Reorder:
+    def __init__(self, window, emit):
+        self.window = max(window, correlator_hold())
+        self.emit = emit
+        self.in_order = collections.deque()
+        self.out_of_order = []
+        self.sequence = 0
+        self.newest = None
+        self.emitted = None
+        self.late = 0
+
+    def push(self, detector, event):
+        entry = (event.ts, self.sequence, detector, event)
+        self.sequence += 1
+        if self.newest is None or event.ts >= self.newest:
+            self.in_order.append(entry)
+            if self.newest is None or event.ts > self.newest:
+                self.newest = event.ts
+                self.release(event.ts - self.window)
+        else:
+            heapq.heappush(self.out_of_order, entry)
+
+    def release(self, until):
+        in_order, out_of_order = self.in_order, self.out_of_order
+        while True:
+            if out_of_order and (not in_order or out_of_order[0][:2] < in_order[0][:2]):
+                if out_of_order[0][0] > until:
+                    return
+                ts, sequence, detector, event = heapq.heappop(out_of_order)
+            elif in_order and in_order[0][0] <= until:
+                ts, sequence, detector, event = in_order.popleft()
+            else:
+                return
+            if self.emitted is not None and ts < self.emitted:
+                self.late += 1
+            else:
+                self.emitted = ts
+            self.emit(detector, event)
+
+    def flush(self):
+        self.release(float('inf'))
+
+# Stands in for a category's event list in process_logs, passing events to the Reorder
+class ReorderEvents:
+    __slots__ = ('reorder', 'detector')
+
+    def __init__(self, reorder, detector):
+        self.reorder = reorder
+        self.detector = detector
+
+    def append(self, event):
+        self.reorder.push(self.detector, event)
+
+def interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=1, help='number of worker processes scanning log files in parallel')
+    parser.add_argument('--threads', type=int, default=1, help='without --jobs, number of threads decompressing the next log files while matching runs; 0 reads them in turn')
+    parser.add_argument('--state', help='checkpoint file; archives already scanned in an earlier run are not read again (their matches are kept in the STATE.d directory)')
+    parser.add_argument('--since', type=parse_time_arg, help='only events at or after this time (2024-03-01T08:00, or 90m, 24h, 7d ago)')
+    parser.add_argument('--until', type=parse_time_arg, help='only events at or before this time')
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json', help='ndjson writes one event per line, in log order, while scanning')
+    parser.add_argument('--rollup', type=int, metavar='SECONDS', help='also report event counts per key and time bucket of this many seconds')
+    parser.add_argument('--rollup-only', action='store_true', help='with --rollup, leave out the individual events')
+    parser.add_argument('--stats', nargs='?', const='-', metavar='FILE', help='report lines tested, matched and time per detector and regex, on stderr or as JSON in FILE')
+    parser.add_argument('--reorder-window', type=int, default=300, metavar='SECONDS', help='how far out of time order a log line may be and still be reported in order; never less than the 60 s a TxSentry record may wait for its query')
+    parser.add_argument('--root', action='append', dest='roots', metavar='DIR', help='extracted support bundle of a host; repeat for several hosts, merged into one timeline with a host column')
+    parser.add_argument('--store', metavar='DB', help='also add the events to this SQLite file, kept across runs')
+    parser.add_argument('--query', metavar='CATEGORY', choices=[detector['category'] for detector in detectors], help='print the events of a category from --store instead of scanning; filters are --service, --host, --since and --until')
+    parser.add_argument('--service', help='with --query, only this service')
+    parser.add_argument('--host', help='with --query, only this host')
+    parser.add_argument('--count-by', metavar='FIELDS', help='with --query, count events per comma-separated fields, host, day, hour or month')
+    parser.add_argument('--follow', action='store_true', help='keep running and write new events of the live log as NDJSON as they are logged')
+    parser.add_argument('--poll', type=float, default=1.0, metavar='SECONDS', help='with --follow, how often to check the live log for new lines')
+    parser.add_argument('--dedup-window', type=int, default=3600, metavar='SECONDS', help='how many seconds of log time event keys are remembered to drop duplicates; 0 remembers every key')
+    args = parser.parse_args()
+    if args.rollup_only and not args.rollup:
+        parser.error('--rollup-only needs --rollup')
+    if args.query and not args.store:
+        parser.error('--query needs --store')
+    if args.count_by and not args.query:
+        parser.error('--count-by needs --query')
+    if args.follow and (args.until is not None or args.rollup or args.state or args.stats):
+        parser.error('--follow cannot be combined with --until, --rollup, --state or --stats')
+    if args.roots and (args.follow or args.rollup or args.state or args.stats):
+        parser.error('--root cannot be combined with --follow, --rollup, --state or --stats')
+
+    if args.query:
+        count_by = args.count_by.split(',') if args.count_by else ()
+        detector = detectors_by_category[args.query]
+        if args.service is not None and 'service' not in detector['fields']:
+            parser.error(f'--service: {args.query} has no service field')
+        for name in count_by:
+            if name not in store_periods and name != 'host' and name not in detector['fields']:
+                parser.error(f'--count-by: {args.query} has no field {name}')
+        if not os.path.isfile(args.store):
+            parser.error(f'--store: no such file {args.store}')
+        try:
+            rows = query_store(args.store, args.query, args.service, args.host, args.since, args.until, count_by)
+        except sqlite3.DatabaseError as e:
+            parser.error(f'--store {args.store}: {e}')
+        if args.format == 'ndjson':
+            for row in rows:
+                sys.stdout.write(json.dumps(row) + '\n')
+        else:
+            json.dump({args.query: {"data": rows}}, sys.stdout)
+            sys.stdout.write('\n')
+        return
+
+    store = EventStore(args.store) if args.store else None
+    if args.roots:
+        hosts = list(zip(args.roots, host_names(args.roots)))
+        metadata, events = merge_hosts(hosts, scan_hosts(hosts, args.since, args.until, args.jobs, args.dedup_window, args.reorder_window, args.threads))
+        if store is not None:
+            events = {detector['category']: store_events(store, detector, events[detector['category']]) for detector in detectors}
+        if args.format == 'ndjson':
+            writer = NdjsonWriter(sys.stdout)
+            writer.write({'category': 'metadata', **metadata})
+            timeline = heapq.merge(*[zip(itertools.repeat(detector), events[detector['category']]) for detector in detectors],
+                                   key=lambda pair: pair[1].ts)
+            for detector, event in timeline:
+                writer.append(detector, event)
+        else:
+            write_json_report(sys.stdout, metadata, events, host_column=True)
+        if store is not None:
+            store.close()
+        return
+
+    if args.follow:
+        # Starts at the end of the live log, or at --since, and leaves the archives alone
+        writer = NdjsonWriter(sys.stdout)
+        writer.write({'category': 'metadata', **report_dates(log_files())})
+        events = {detector['category']: NdjsonEvents(writer, detector) for detector in detectors}
+        if store is not None:
+            events = {detector['category']: StoreEvents(events[detector['category']], store, detector) for detector in detectors}
+        offset = find_offset(live_log, args.since) if args.since is not None and os.path.exists(live_log) else None
+        # A service manager stops the follower with SIGTERM: finish it as on Ctrl-C, so open
+        # TxSentry records, buffered output and the pending store batch are written
+        signal.signal(signal.SIGTERM, interrupt)
+        try:
+            follow_logs(live_log, events, RecentKeys(args.dedup_window), writer, offset, args.poll, store)
+        except KeyboardInterrupt:
+            writer.out.flush()
+        if store is not None:
+            store.close()
+        return
+
+    seen_events = RecentKeys(args.dedup_window)
+    state = load_state(args.state) if args.state else None
+    metadata = report_dates(log_files(), state.setdefault('first_timestamps', {}) if state is not None else None)
+    rollup = Rollup(args.rollup) if args.rollup else None
+    if args.format == 'ndjson':
+        writer = NdjsonWriter(sys.stdout)
+        writer.write({'category': 'metadata', **metadata})
+        reorder = Reorder(args.reorder_window, writer.append)
+    else:
+        events = {} if args.rollup_only else {detector['category']: [] for detector in detectors}
+        reorder = Reorder(args.reorder_window, lambda detector, event: events[detector['category']].append(event))
+    sinks = {} if args.rollup_only else {detector['category']: ReorderEvents(reorder, detector) for detector in detectors}
+    if rollup is not None:
+        sinks = {detector['category']: RollupEvents(sinks.get(detector['category']), rollup, detector) for detector in detectors}
+    if store is not None:
+        sinks = {detector['category']: StoreEvents(sinks.get(detector['category']), store, detector) for detector in detectors}
+    if args.stats:
+        global stats
+        stats = ScanStats()
+    started = time.perf_counter()
+    process_logs(sinks, seen_events, args.jobs, state, args.since, args.until, threads=args.threads)
+    reorder.flush()
+    if stats is not None:
+        stats.total_seconds = time.perf_counter() - started
+        if args.stats == '-':
+            stats.write_table(sys.stderr)
+        else:
+            with open(args.stats, 'w') as file:
+                json.dump(stats.to_dict(), file, indent=2)
+
+    if args.format == 'ndjson':
+        if reorder.late:
+            print(f"{reorder.late} events were logged more than {reorder.window}s out of order and written out of order; raise --reorder-window", file=sys.stderr)
+        if rollup is not None:
+            for detector in detectors:
+                for row in rollup.rows(detector):
+                    writer.write({'category': detector['category'], 'rollup': True, **row})
+    else:
+        # Only needed when lines were further out of order than the reorder window
+        if reorder.late:
+            for event_list in events.values():
+                event_list.sort(key=lambda event: event.ts)
+        write_json_report(sys.stdout, metadata, events, rollup)
+    if store is not None:
+        store.close()
+    # A windowed run only reads part of the logs, so it must not replace the checkpoint
+    if args.state and args.since is None and args.until is None:
+        save_state(args.state, state)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,46 @@
+import bench_issues_8
+import issues_8_cmd
+
+# A line the generator writes for each event, by category: a small generated tree must give
+# exactly one event per such line (TxSentry queries are attached to their process line)
+markers = {
+    'OOM': [b'Discovered out-of-memory error', b'java.lang.OutOfMemoryError'],
+    'TxSentry': [b'Found unmanaged process', b'Found a process'],
+    'ReferenceDataProcessorThread': [b'crossed the update threshold'],
+    'ExpensiveRules': [b'Expensive Custom Rules'],
+    'TooManyOpenFiles': [b'Too many open files'],
+    'CacheOverflow': [b'is experiencing heavy'],
+    'DroppedReceive': [b'Dropped receive packets'],
+    'ConnectLocalhost': [b'Unable to connect to server localhost'],
+}
+
+def generated_counts(root):
+    counts = dict.fromkeys(markers, 0)
+    for path in issues_8_cmd.log_files(root):
+        for line in b''.join(issues_8_cmd.read_blocks(path)).split(b'\n'):
+            for category, literals in markers.items():
+                if any(literal in line for literal in literals):
+                    counts[category] += 1
+    return counts
+
+def test_generated_tree_event_counts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / 'logs')
+    total = bench_issues_8.generate_logs(root, files=3, lines=2000, mix=dict(bench_issues_8.default_mix, noise=20), seed=3)
+    assert bench_issues_8.count_lines(root) == total
+
+    expected = generated_counts(root)
+    assert all(expected.values())
+    assert bench_issues_8.scan_once(root, 1, 1)['events'] == expected
+
+def test_scan_of_one_detector(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = str(tmp_path / 'logs')
+    bench_issues_8.generate_logs(root, files=2, lines=1000, seed=5)
+    expected = generated_counts(root)
+
+    monkeypatch.setattr(issues_8_cmd, 'dispatch', issues_8_cmd.dispatch)
+    monkeypatch.setattr(issues_8_cmd, 'byte_dispatch', issues_8_cmd.byte_dispatch)
+    monkeypatch.setattr(issues_8_cmd, 'keywords', issues_8_cmd.keywords)
+    events = bench_issues_8.scan_once(root, 1, 1, 'CacheOverflow')['events']
+    assert events == dict.fromkeys(markers, 0) | {'CacheOverflow': expected['CacheOverflow']}
@@ -0,0 +1,288 @@
+import os
+
+import pytest
+
+import bench_issues_8
+import issues_8_cmd
+
+# Golden corpus: a line for every pattern of every detector, with the groups that pattern
+# captures from it. A pattern rewrite must keep these captures, for the str patterns and the
+# bytes copies the scan uses alike.
+golden = [
+    ('OOM', 0, "Mar  3 10:00:01 qradar-console OutOfMemoryMonitor[4242]: Discovered out-of-memory error for ecs-ec (type java)",
+     {'date': 'Mar  3 10:00:01', 'service': 'ecs-ec '}),
+    ('OOM', 1, "Mar  3 10:00:02 qradar-console OutOfMemoryMonitor[4242]: Discovered out-of-memory error for tomcat process.",
+     {'date': 'Mar  3 10:00:02', 'service': 'tomcat'}),
+    ('OOM', 2, "Mar  3 10:00:03 qradar-console ecs-ec[1234]: [Thread-42] java.lang.OutOfMemoryError: Java heap space",
+     {'date': 'Mar  3 10:00:03', 'service': 'Thread-42'}),
+    ('TxSentry', 0, "Mar  3 10:00:04 qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-3/Sequential-1] "
+     "com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][10.1.2.3/- -] [-/- -]Found unmanaged process on host 10.1.2.3: "
+     "/usr/bin/httpd, pid=4711, started 3600s ago",
+     {'date': 'Mar  3 10:00:04', 'thread_key': 'tx-3', 'service': '/usr/bin/httpd', 'pid': '4711'}),
+    ('TxSentry', 1, "Mar  3 10:00:04 qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-3/Sequential-1] "
+     "com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][10.1.2.3/- -] [-/- -]TX on host 10.1.2.3: pid=4711 age=120 "
+     "query='select * from reference_data_element where rdk_id = 1052'",
+     {'date': 'Mar  3 10:00:04', 'thread_key': 'tx-3', 'pid': '4711', 'query': 'select * from reference_data_element where rdk_id = 1052'}),
+    ('TxSentry', 2, "Mar  3 10:00:05 qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-7/Sequential-1] "
+     "com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][10.1.2.9/- -] [-/- -]Found a process on host 10.1.2.9: ecs-ep, "
+     "pid=812, managed",
+     {'date': 'Mar  3 10:00:05', 'thread_key': 'tx-7', 'service': 'ecs-ep', 'pid': '812'}),
+    ('ReferenceDataProcessorThread', 0, "Mar  3 10:00:06 qradar-console tomcat[900]: [INFO] [ReferenceDataProcessorThread] "
+     "ReferenceDataProcessorThread - We have crossed the update threshold of 5000 elements",
+     {'date': 'Mar  3 10:00:06'}),
+    ('ExpensiveRules', 0, "Mar  3 10:00:07 qradar-console ecs-ep[901]: [INFO] [ecs-ep.ecs-ep] Expensive Custom Rules Based On "
+     "Average Throughput: Rule 101 (0.512 ms), Rule 202 (0.250 ms)",
+     {'date': 'Mar  3 10:00:07', 'rules': 'Rule 101 (0.512 ms), Rule 202 (0.250 ms)'}),
+    ('TooManyOpenFiles', 0, "Mar  3 10:00:08 qradar-console hostcontext[77]: [S.hostcontext] - Too many open files",
+     {'date': 'Mar  3 10:00:08', 'service': 'hostcontext'}),
+    ('TooManyOpenFiles', 1, "Mar  3 10:00:09 qradar-console java[77]: x: Too many open files",
+     {'date': 'Mar  3 10:00:09', 'service': 'java'}),
+    ('TooManyOpenFiles', 2, "Mar  3 10:00:10 qradar-console tomcat[1234]: [tomcat.tomcat] [pool-3] java.io.IOException: Too many open files",
+     {'date': 'Mar  3 10:00:10', 'service': 'tomcat'}),
+    ('TooManyOpenFiles', 3, "Mar  3 10:00:11 qradar-console [ecs-ec] Too many open files",
+     {'date': 'Mar  3 10:00:11', 'service': 'ecs-ec'}),
+    ('TooManyOpenFiles', 4, "Mar  3 10:00:12 qradar-console ecs-ec-ingress: [ecs.ingress] Too many open files",
+     {'date': 'Mar  3 10:00:12', 'service': 'ecs'}),
+    ('CacheOverflow', 0, "Mar  3 10:00:13 qradar-console ecs-ec[1500]: [ecs-ec.ecs-ec] [pool-1] com.q1labs.frameworks.cache.ChainAppendCache: "
+     "[WARN] [NOT:0000004000][10.1.2.3/- -] [-/- -]FlowSourceCache is experiencing heavy COLLISIONS exceeding configured threshold 42",
+     {'date': 'Mar  3 10:00:13', 'service': 'ecs-ec', 'cache': 'FlowSourceCache',
+      'message': 'is experiencing heavy COLLISIONS exceeding configured threshold 42'}),
+    ('DroppedReceive', 0, "Mar  3 10:00:14 qradar-console hostcontext[88]: Dropped receive packets on interface eth1 has an average of "
+     "12.50 over the past 5 intervals, and has exceeded the configured threshold of 1.00",
+     {'date': 'Mar  3 10:00:14', 'interface': 'eth1', 'over_5_intervals': '12.50', 'threshold': '1.00'}),
+    ('ConnectLocalhost', 0, "Mar  3 10:00:15 qradar-console tomcat[99]: [tomcat.tomcat] [main]Unable to connect to server localhost:7777",
+     {'date': 'Mar  3 10:00:15', 'port': '7777'}),
+]
+
+# Lines that carry a detector's literal but are not its event
+near_misses = [
+    "Mar  3 10:00:16 qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [tx-3/Sequential-1] TxSentry: nothing to report",
+    "Mar  3 10:00:17 qradar-console ecs-ec[1]: Too many open",
+    "Mar  3 10:00:18 qradar-console tomcat[99]: Unable to connect to server localhost:",
+    "Mar  3 10:00:19 qradar-console systemd[1]: Started Session 12 of user root.",
+]
+
+# Longest a pattern may take on one adversarial line, as in bench_issues_8.py check
+budget_ms = 50
+
+@pytest.mark.parametrize('category, index, line, groups', golden)
+def test_golden_captures(category, index, line, groups):
+    detector = issues_8_cmd.detectors_by_category[category]
+    assert detector['patterns'][index].search(line).groupdict() == groups
+    match = detector['byte_patterns'][index].search(line.encode())
+    assert issues_8_cmd.decode_groups(match, detector['errors']) == groups
+
+def test_golden_covers_every_pattern():
+    covered = {(category, index) for category, index, line, groups in golden}
+    assert covered == {(detector['category'], index) for detector in issues_8_cmd.detectors for index in range(len(detector['patterns']))}
+
+@pytest.mark.parametrize('category, index, line, groups', golden)
+def test_match_line_category(category, index, line, groups):
+    assert [category] == [matched for matched, matched_groups in issues_8_cmd.match_line(line.encode())]
+
+@pytest.mark.parametrize('line', near_misses)
+def test_near_misses(line):
+    assert issues_8_cmd.match_line(line.encode()) == []
+
+def test_non_ascii_line():
+    category, index, line, groups = golden[4]
+    raw = line.replace('rdk_id = 1052', 'name = \'caf\xe9\'').encode('latin-1')
+    [(matched, matched_groups)] = issues_8_cmd.match_line(raw)
+    assert matched == category
+    assert matched_groups['query'] == "select * from reference_data_element where name = 'caf\ufffd'"
+
+def test_patterns_within_budget():
+    slow = [row for row in bench_issues_8.check_patterns() if row['seconds'] * 1000 > budget_ms]
+    assert slow == []
+
+def txsentry_record(clock, thread_key, service):
+    return (f"Mar  3 {clock} qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [{thread_key}/Sequential-1] "
+            f"com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][10.1.2.3/- -] [-/- -]Found unmanaged process on host "
+            f"10.1.2.3: {service}, pid=4711, started 3600s ago")
+
+def txsentry_query(clock, thread_key, query):
+    return (f"Mar  3 {clock} qradar-console hostcontext[55]: [INFO] [hostcontext.hostcontext] [{thread_key}/Sequential-1] "
+            f"com.q1labs.hostcontext.tx.TxSentry: [INFO] [NOT:0000006000][10.1.2.3/- -] [-/- -]TX on host 10.1.2.3: pid=4711 "
+            f"age=120 query='{query}'")
+
+def write_live_log(root, lines):
+    log_dir = root / 'var' / 'log'
+    log_dir.mkdir(parents=True, exist_ok=True)
+    (log_dir / 'qradar.error').write_text(''.join(line + '\n' for line in lines))
+
+# TxSentry events of a scan of the lines as (time, service, query), in the order passed on
+def txsentry_events(tmp_path, monkeypatch, lines, jobs=1):
+    write_live_log(tmp_path, lines)
+    monkeypatch.chdir(tmp_path)
+    events = {detector['category']: [] for detector in issues_8_cmd.detectors}
+    issues_8_cmd.process_logs(events, issues_8_cmd.RecentKeys(3600), jobs)
+    return [(issues_8_cmd.epoch_to_datetime(event.ts).strftime('%H:%M:%S'), *event.values[:2]) for event in events['TxSentry']]
+
+def test_txsentry_interleaved_thread_keys(tmp_path, monkeypatch):
+    lines = [
+        txsentry_record('10:00:00', 'tx-1', 'httpd'),
+        txsentry_record('10:00:01', 'tx-2', 'sshd'),
+        txsentry_query('10:00:02', 'tx-1', 'select 1'),
+        txsentry_query('10:00:03', 'tx-2', 'select 2'),
+    ]
+    assert txsentry_events(tmp_path, monkeypatch, lines) == [('10:00:00', 'httpd', 'select 1'), ('10:00:01', 'sshd', 'select 2')]
+
+def test_txsentry_query_logged_before_its_record(tmp_path, monkeypatch):
+    lines = [
+        txsentry_query('10:00:02', 'tx-1', 'select 1'),
+        txsentry_record('10:00:01', 'tx-1', 'httpd'),
+    ]
+    assert txsentry_events(tmp_path, monkeypatch, lines) == [('10:00:01', 'httpd', 'select 1')]
+
+def test_txsentry_record_replaced_on_its_thread_key(tmp_path, monkeypatch):
+    lines = [
+        txsentry_record('10:00:00', 'tx-1', 'httpd'),
+        txsentry_record('10:00:05', 'tx-1', 'sshd'),
+        txsentry_query('10:00:06', 'tx-1', 'select 1'),
+    ]
+    assert txsentry_events(tmp_path, monkeypatch, lines) == [('10:00:00', 'httpd', ''), ('10:00:05', 'sshd', 'select 1')]
+
+def test_txsentry_expiry_releases_in_time_order(tmp_path, monkeypatch):
+    lines = [
+        txsentry_record('10:00:00', 'tx-1', 'httpd'),
+        txsentry_query('10:00:10', 'tx-2', 'orphan'),
+        txsentry_record('10:00:20', 'tx-3', 'sshd'),
+        # Too late for the tx-3 record
+        txsentry_query('10:01:30', 'tx-3', 'select 3'),
+    ]
+    assert txsentry_events(tmp_path, monkeypatch, lines) == [
+        ('10:00:00', 'httpd', ''), ('10:00:10', '', 'orphan'), ('10:00:20', 'sshd', ''), ('10:01:30', '', 'select 3'),
+    ]
+
+def test_txsentry_released_while_scanning():
+    correlator = issues_8_cmd.TxSentryCorrelator()
+    detector = issues_8_cmd.detectors_by_category['TxSentry']
+    events = []
+    correlator.add(detector, {'date': 'Mar  3 10:00:00', 'service': 'httpd', 'thread_key': 'tx-1'}, events, issues_8_cmd.RecentKeys(3600))
+    ts = issues_8_cmd.parse_syslog_date('Mar  3 10:00:00')
+    correlator.advance(events, ts + correlator.expiry)
+    assert events == []
+    correlator.advance(events, ts + correlator.expiry + 1)
+    assert [event.values[0] for event in events] == ['httpd']
+
+def test_txsentry_split_across_jobs(tmp_path, monkeypatch):
+    mix = dict.fromkeys(bench_issues_8.default_mix, 0) | {'txsentry': 1, 'noise': 1}
+    bench_issues_8.generate_logs(str(tmp_path), files=1, lines=2000, mix=mix, seed=7)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(issues_8_cmd, 'split_size', 1 << 14)
+    assert len(issues_8_cmd.split_range(issues_8_cmd.live_log, 0, None, 4)) == 4
+    events = {}
+    for jobs in (1, 4):
+        events[jobs] = {detector['category']: [] for detector in issues_8_cmd.detectors}
+        issues_8_cmd.process_logs(events[jobs], issues_8_cmd.RecentKeys(3600), jobs)
+    assert [(event.ts, event.values) for event in events[4]['TxSentry']] == [(event.ts, event.values) for event in events[1]['TxSentry']]
+    assert any(event.values[1] for event in events[1]['TxSentry'])
+
+def test_reorder_window_covers_txsentry_hold(tmp_path, monkeypatch):
+    lines = [txsentry_record('10:00:00', 'tx-1', 'httpd')]
+    lines += [f"Mar  3 10:00:{second:02d} qradar-console tomcat[99]: [main]Unable to connect to server localhost:7777" for second in range(1, 30)]
+    lines.append(txsentry_query('10:00:30', 'tx-1', 'select 1'))
+    write_live_log(tmp_path, lines)
+    monkeypatch.chdir(tmp_path)
+    emitted = []
+    reorder = issues_8_cmd.Reorder(10, lambda detector, event: emitted.append(event.ts))
+    assert reorder.window == issues_8_cmd.TxSentryCorrelator.default_expiry
+    issues_8_cmd.process_logs({detector['category']: issues_8_cmd.ReorderEvents(reorder, detector) for detector in issues_8_cmd.detectors},
+                              issues_8_cmd.RecentKeys(3600))
+    reorder.flush()
+    assert reorder.late == 0
+    assert len(emitted) == 30 and emitted == sorted(emitted)
+
+def test_store_strips_service(tmp_path):
+    path = str(tmp_path / 'events.db')
+    detector = issues_8_cmd.detectors_by_category['OOM']
+    store = issues_8_cmd.EventStore(path)
+    store.add(detector, issues_8_cmd.Event(1000, ('ecs-ec ',)))
+    store.add(detector, issues_8_cmd.Event(2000, ('ecs-ec',)))
+    store.close()
+    assert issues_8_cmd.query_store(path, 'OOM', service='ecs-ec', count_by=('service',)) == [{'service': 'ecs-ec', 'count': 2}]
+
+def test_rollup_strips_key_values():
+    detector = issues_8_cmd.detectors_by_category['OOM']
+    rollup = issues_8_cmd.Rollup(3600)
+    rollup.add(detector, issues_8_cmd.Event(7200, ('ecs-ec ',)))
+    rollup.add(detector, issues_8_cmd.Event(7300, ('ecs-ec',)))
+    assert [(row['service'], row['count']) for row in rollup.rows(detector)] == [('ecs-ec', 2)]
+
+@pytest.mark.parametrize('date', ['Foo 12 10:00:00', 'Feb 30 10:00:00', 'Mar 32 10:00:00', 'Mar  3 99:99:99', 'Mar  3 24:00:00', 'Mar  3 10:60:00'])
+def test_impossible_dates(date):
+    assert issues_8_cmd.parse_syslog_date(date) is None
+    assert issues_8_cmd.line_timestamp(date + ' qradar-console tomcat[1]: x') is None
+
+def test_query_store_does_not_create_a_store(tmp_path):
+    path = str(tmp_path / 'missing store.db')
+    with pytest.raises(issues_8_cmd.sqlite3.OperationalError):
+        issues_8_cmd.query_store(path, 'OOM')
+    assert not (tmp_path / 'missing store.db').exists()
+
+def oom_line(clock, thread):
+    return f"Mar  3 {clock} qradar-console ecs-ec[1234]: [Thread-{thread}] java.lang.OutOfMemoryError: Java heap space"
+
+# Events of a scan, from the checkpoint at state_path when given (which is then saved)
+def scanned_events(state_path=None):
+    events = {detector['category']: [] for detector in issues_8_cmd.detectors}
+    state = issues_8_cmd.load_state(state_path) if state_path else None
+    issues_8_cmd.process_logs(events, issues_8_cmd.RecentKeys(3600), 1, state)
+    if state is not None:
+        issues_8_cmd.save_state(state_path, state)
+    return {category: [(event.ts, event.values) for event in event_list] for category, event_list in events.items()}
+
+def test_state_refresh_matches_full_scan(tmp_path, monkeypatch):
+    bench_issues_8.generate_logs(str(tmp_path), files=4, lines=1000, seed=11)
+    monkeypatch.chdir(tmp_path)
+    state_path = str(tmp_path / 'state.json')
+    full = scanned_events()
+    assert scanned_events(state_path) == full
+    assert scanned_events(state_path) == full
+    with open(issues_8_cmd.live_log, 'a') as file:
+        file.write(oom_line('23:59:59', 7) + '\n')
+    assert scanned_events(state_path) == scanned_events()
+
+def test_state_partial_last_line(tmp_path, monkeypatch):
+    write_live_log(tmp_path, [oom_line('10:00:00', 1)])
+    monkeypatch.chdir(tmp_path)
+    state_path = str(tmp_path / 'state.json')
+    partial = oom_line('10:00:01', 2)
+    with open(issues_8_cmd.live_log, 'a') as file:
+        file.write(partial[:60])
+    # A scan without --state reads the last line as it is; with one, it waits for the newline
+    assert len(scanned_events()['OOM']) == 1
+    assert len(scanned_events(state_path)['OOM']) == 1
+    with open(issues_8_cmd.live_log, 'a') as file:
+        file.write(partial[60:] + '\n')
+    assert scanned_events(state_path) == scanned_events()
+    assert len(scanned_events(state_path)['OOM']) == 2
+
+def test_state_restarts_rotated_or_truncated_live_log(tmp_path, monkeypatch):
+    write_live_log(tmp_path, [oom_line('10:00:00', 1), oom_line('10:00:01', 2), oom_line('10:00:02', 3)])
+    monkeypatch.chdir(tmp_path)
+    state_path = str(tmp_path / 'state.json')
+    scanned_events(state_path)
+    # Rotation: a new file (new inode) at the live log's path
+    os.replace(issues_8_cmd.live_log, str(tmp_path / 'old'))
+    # longer than the offset reached in the old one
+    write_live_log(tmp_path, [oom_line(f'11:00:0{second}', 10 + second) for second in range(4)])
+    assert scanned_events(state_path) == scanned_events()
+    # copytruncate: the same inode, now shorter than the offset reached
+    with open(issues_8_cmd.live_log, 'w') as file:
+        file.write(oom_line('12:00:00', 6) + '\n')
+    assert scanned_events(state_path) == scanned_events()
+    with open(issues_8_cmd.live_log, 'a') as file:
+        file.write(oom_line('12:00:01', 7) + '\n')
+    assert scanned_events(state_path) == scanned_events()
+    assert len(scanned_events(state_path)['OOM']) == 2
+
+def test_state_discarded_when_detectors_change(tmp_path, monkeypatch):
+    write_live_log(tmp_path, [oom_line('10:00:00', 1)])
+    monkeypatch.chdir(tmp_path)
+    state_path = str(tmp_path / 'state.json')
+    scanned_events(state_path)
+    assert issues_8_cmd.load_state(state_path)['live']['offset'] > 0
+    monkeypatch.setattr(issues_8_cmd, 'detectors_signature', lambda: 'changed')
+    assert issues_8_cmd.load_state(state_path) == {'hits_dir': state_path + '.d'}
+    assert len(scanned_events(state_path)['OOM']) == 1